@@ -0,0 +1,117 @@
+"""Compact representation of rigid body poses as a position and a quaternion.
+
+Copyright (c) 2014, Garth Zeglin.  All rights reserved. Licensed under the terms
+of the BSD 3-clause license as included in LICENSE.
+
+A pose is stored as 7 floats, a position vector followed by a (w,x,y,z) unit
+quaternion, instead of the 16 floats of a 4x4 homogeneous transform.  A Pose
+object may hold a single pose or a stack of N poses in an N x 7 array, and
+every operation broadcasts over the stack, so a whole trajectory can be
+composed, inverted, or applied to points in one call.
+
+Rigid motions are composed and inverted directly with quaternion operations,
+so the inverse is exact by construction and needs no general matrix
+inversion.
+"""
+
+import numpy as np
+
+# local to this package
+import quaternion as quat
+import utility
+
+#================================================================
+class Pose(object):
+    """A rigid body pose, or a stack of poses, stored as position and quaternion.
+
+    Attributes:
+    data -- ... x 7 array holding (x, y, z, qw, qx, qy, qz) for each pose
+
+    The properties x and q are views of the position and quaternion columns.
+    Poses compose by multiplication: (A * B).apply(p) == A.apply(B.apply(p)).
+    """
+
+    def __init__( self, x = (0.0, 0.0, 0.0), q = (1.0, 0.0, 0.0, 0.0) ):
+        """Create a pose from a position vector and a (w,x,y,z) quaternion, or from
+        N x 3 positions and N x 4 quaternions, broadcasting one against the other.
+        The default is the identity pose.
+        """
+        x = np.asarray( x, dtype=float )
+        q = np.asarray( q, dtype=float )
+        shape = np.broadcast( x[...,0], q[...,0] ).shape
+        self.data = np.empty( shape + (7,) )
+        self.data[...,0:3] = x
+        self.data[...,3:7] = q
+
+    @classmethod
+    def from_array( cls, data ):
+        """Create a pose directly from a 7-element array or an N x 7 array."""
+        pose = cls.__new__( cls )
+        pose.data = np.asarray( data, dtype=float )
+        return pose
+
+    @classmethod
+    def from_threexform( cls, T ):
+        """Create a pose from a 4x4 homogeneous transform or an N x 4 x 4 array of transforms."""
+        T = np.asarray( T, dtype=float )
+        return cls( T[...,0:3,3], quat.from_threexform( T ))
+
+    @property
+    def x( self ):
+        """The position vector, or N x 3 array of positions."""
+        return self.data[...,0:3]
+
+    @property
+    def q( self ):
+        """The (w,x,y,z) quaternion, or N x 4 array of quaternions."""
+        return self.data[...,3:7]
+
+    def __len__( self ):
+        if self.data.ndim == 1:
+            raise TypeError( "len() of a single pose" )
+        return len( self.data )
+
+    def __getitem__( self, index ):
+        if self.data.ndim == 1:
+            raise TypeError( "a single pose cannot be indexed" )
+        return Pose.from_array( self.data[index] )
+
+    def __repr__( self ):
+        return "Pose(%s)" % self.data
+
+    def to_threexform( self ):
+        """Return the 4x4 homogeneous transform, or N x 4 x 4 array of transforms."""
+        return utility.pos_quat_to_threexform( self.x, self.q )
+
+    def compose( self, other ):
+        """Return the pose self * other, the pose other expressed in the frame of self."""
+        q = quat.normalize( quat.multiply( self.q, other.q ))
+        return Pose( self.x + quat.rotate_vector( self.q, other.x ), q )
+
+    __mul__ = compose
+
+    def inverse( self ):
+        """Return the inverse rigid motion, i.e. the pose of the parent frame in this frame."""
+        q = quat.conjugate( self.q )
+        return Pose( -quat.rotate_vector( q, self.x ), q )
+
+    def apply( self, points ):
+        """Transform a 3-element point, or an N x 3 array of points, from this frame into the parent frame.
+
+        A single pose applies to every point, and a stack of N poses applies
+        to N points pairwise.
+        """
+        return quat.rotate_vector( self.q, points ) + self.x
+
+################################################################
+
+if __name__ == "__main__":
+    """Run some trivial tests when executed as a main module."""
+    np.set_printoptions(suppress=True, precision=5)
+
+    A = Pose( (100.0, 0.0, 50.0), quat.axis_angle( np.array((0.0, 0.0, 1.0)), 0.5*np.pi ))
+    B = Pose( (0.0, 10.0, 0.0), quat.axis_angle( np.array((1.0, 0.0, 0.0)), 0.1 ))
+    print "composed pose:\n", A * B
+    print "matches transform product:", np.allclose( (A * B).to_threexform(), np.dot( A.to_threexform(), B.to_threexform() ))
+    print "inverse is identity:", np.allclose( (A * A.inverse()).to_threexform(), np.identity(4) )
+    print "applied to a point:", A.apply( (1.0, 2.0, 3.0) )
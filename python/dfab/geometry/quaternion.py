@@ -5,7 +5,11 @@ of the BSD 3-clause license as included in LICENSE.
 
 All quaternions are represented as a 4 element numpy ndarray, following a (w,x,y,z) convention.
 
-All operators are pure Python for portability.
+Every operator also accepts stacks of quaternions and vectors, i.e. arrays
+with shape (...,4) or (...,3), and broadcasts its arguments together in the
+usual numpy fashion; for example, to_threexform maps an N x 4 array of
+quaternions to an N x 4 x 4 array of transforms.  A single quaternion gives
+the same result as before.
 
 N.B. this is not well tested, efficient, or optimized.
 
@@ -19,18 +23,26 @@ def axis_angle( axis, angle ):
     """Return the quaternion corresponding to a rotation around an axis.
 
     Arguments: (axis, angle)
-    axis  -- three element vector
-    angle -- scalar representing an angle in radians.
+    axis  -- three element vector, or N x 3 array of vectors
+    angle -- scalar representing an angle in radians, or N-element array of angles
     """
+    axis = np.asarray( axis )
+    if axis.ndim == 1 and np.ndim( angle ) == 0:
+        # the scale factor normalizes the axis vector and multiplies by half the sine in one step
+        scale = np.sin( angle / 2 ) / np.sqrt(np.dot(axis, axis))
+        return np.array(( np.cos(angle/2), scale*axis[0], scale*axis[1], scale*axis[2] ))
 
-    # the scale factor normalizes the axis vector and multiplies by half the sine in one step
-    scale = np.sin( angle / 2 ) / np.sqrt(np.dot(axis, axis))
-    return np.array(( np.cos(angle/2), scale*axis[0], scale*axis[1], scale*axis[2] ))
+    angle, norm = np.broadcast_arrays( np.asarray( angle, dtype=float ), np.sqrt( np.sum( axis * axis, axis=-1 )))
+    scale = np.sin( angle / 2 ) / norm
+    return np.concatenate(( np.cos( angle/2 )[...,np.newaxis], scale[...,np.newaxis] * axis ), axis=-1 )
 
 
 def vector( v ):
-    """Return the quaternion representing a three-element vector."""
-    return np.array(( 0, v[0], v[1], v[2] ))
+    """Return the quaternion representing a three-element vector, or an N x 4 array for an N x 3 array."""
+    v = np.asarray( v )
+    if v.ndim == 1:
+        return np.array(( 0, v[0], v[1], v[2] ))
+    return np.concatenate(( np.zeros( v.shape[:-1] + (1,), dtype=v.dtype ), v ), axis=-1 )
 
 
 def identity():
@@ -39,63 +51,259 @@ def identity():
 
 
 def normalize( q ):
-    """Return a properly normalized quaternion.
+    """Return a properly normalized quaternion, or an array of normalized quaternions.
 
     Rotation quaternions have unit magnitude, but numerical error can accumulate.
+    A quaternion with zero magnitude is replaced by the identity.
     """
+    q = np.asarray( q )
+    if q.ndim == 1:
+        mag = np.sqrt( np.dot(q,q) )
+        if mag == 0:
+            return identity()
+        else:
+            return q / mag
 
-    mag = np.sqrt( np.dot(q,q) )
-    if mag == 0:
-        return identity()
-    else:
-        return q / mag
+    mag = np.sqrt( np.sum( q * q, axis=-1 ))[...,np.newaxis]
+    return np.where( mag == 0, identity(), q / np.where( mag == 0, 1.0, mag ))
 
 
 def conjugate( q ):
-    """Return the conjugate of a quaternion."""
-    return np.array(( q[0], -q[1], -q[2], -q[3] ))
+    """Return the conjugate of a quaternion, or of each of an array of quaternions."""
+    q = np.asarray( q )
+    if q.ndim == 1:
+        return np.array(( q[0], -q[1], -q[2], -q[3] ))
+    return q * np.array(( 1, -1, -1, -1 ))
 
 
 def multiply( p, q ):
-    """Compute the quaternion product p*q.
+    """Compute the quaternion product p*q, broadcasting over arrays of quaternions.
 
     The product  p * q  = p0q0 - p.q + p0 q + q0 p + p X q
     """
-    return np.array ((  p[0] * q[0] - p[1] * q[1] -  p[2] * q[2] - p[3] * q[3], 
-                        p[0] * q[1] + p[1] * q[0] + (p[2] * q[3])-(p[3] * q[2]), 
-                        p[0] * q[2] + p[2] * q[0] + (p[3] * q[1])-(p[1] * q[3]), 
-                        p[0] * q[3] + p[3] * q[0] + (p[1] * q[2])-(p[2] * q[1]) ))
+    p = np.asarray( p )
+    q = np.asarray( q )
+    r = np.array ((  p[...,0] * q[...,0] - p[...,1] * q[...,1] -  p[...,2] * q[...,2] - p[...,3] * q[...,3],
+                     p[...,0] * q[...,1] + p[...,1] * q[...,0] + (p[...,2] * q[...,3])-(p[...,3] * q[...,2]),
+                     p[...,0] * q[...,2] + p[...,2] * q[...,0] + (p[...,3] * q[...,1])-(p[...,1] * q[...,3]),
+                     p[...,0] * q[...,3] + p[...,3] * q[...,0] + (p[...,1] * q[...,2])-(p[...,2] * q[...,1]) ))
+    return np.moveaxis( r, 0, -1 )
 
 
 def rotate_vector( q, v ):
     """Rotate a three-element vector v by the orientation represented by quaternion q.
 
     Arguments: (q, v)
-    Returns a new vector.
+    q -- quaternion, or N x 4 array of quaternions
+    v -- three-element vector, or N x 3 array of vectors
+
+    Returns a new vector, or an N x 3 array of vectors.
     """
 
     r = multiply( multiply(q, vector(v)), conjugate( q ))
-    return r[1:4]
+    return r[...,1:4]
 
 
 def to_threexform( q ):
-    """Return a 4x4 homogenous matrix representing a quaternion rotation."""
-
-    # this should be fixed to work with a matrix of quaternions
-    return np.array( (( q[0]*q[0]+q[1]*q[1]-q[2]*q[2]-q[3]*q[3],
-                        2*(q[1]*q[2]-q[0]*q[3]),
-                        2*(q[1]*q[3]+q[0]*q[2]),
-                        0.0 ),
-
-                      ( 2*(q[1]*q[2]+q[0]*q[3]),
-                        q[0]*q[0]-q[1]*q[1]+q[2]*q[2]-q[3]*q[3],
-                        2*(q[2]*q[3]-q[0]*q[1]),
-                        0.0 ),
-
-                      ( 2*(q[1]*q[3]-q[0]*q[2]),
-                        2*(q[2]*q[3]+q[0]*q[1]),
-                        q[0]*q[0]-q[1]*q[1]-q[2]*q[2]+q[3]*q[3],
-                        0.0 ),
-                      
-                      ( 0, 0, 0, 1 ) ))
+    """Return a 4x4 homogenous matrix representing a quaternion rotation.
+
+    For an N x 4 array of quaternions, returns an N x 4 x 4 array of matrices.
+    """
+    q = np.asarray( q )
+    w, x, y, z = q[...,0], q[...,1], q[...,2], q[...,3]
+    M = np.zeros( q.shape[:-1] + (4, 4) )
+    M[...,0,0] = w*w+x*x-y*y-z*z
+    M[...,0,1] = 2*(x*y-w*z)
+    M[...,0,2] = 2*(x*z+w*y)
+    M[...,1,0] = 2*(x*y+w*z)
+    M[...,1,1] = w*w-x*x+y*y-z*z
+    M[...,1,2] = 2*(y*z-w*x)
+    M[...,2,0] = 2*(x*z-w*y)
+    M[...,2,1] = 2*(y*z+w*x)
+    M[...,2,2] = w*w-x*x-y*y+z*z
+    M[...,3,3] = 1.0
+    return M
+
+
+def from_threexform( M ):
+    """Return the unit quaternion representing the rotation of a homogeneous transform, the inverse of to_threexform.
+
+    Accepts a 4x4 (or 3x3) matrix, or an N x 4 x 4 array of matrices.  For
+    each matrix the quaternion is computed from whichever of the trace or the
+    diagonal terms is largest, for numerical accuracy near every rotation.
+    The result has a non-negative scalar part.
+    """
+    M = np.asarray( M, dtype=float )
+    m00, m11, m22 = M[...,0,0], M[...,1,1], M[...,2,2]
+    trace = m00 + m11 + m22
+
+    # one candidate quaternion (unnormalized) for each choice of largest term
+    candidates = np.array(( ( 1 + trace,           M[...,2,1] - M[...,1,2], M[...,0,2] - M[...,2,0], M[...,1,0] - M[...,0,1] ),
+                            ( M[...,2,1] - M[...,1,2], 1 + m00 - m11 - m22, M[...,0,1] + M[...,1,0], M[...,0,2] + M[...,2,0] ),
+                            ( M[...,0,2] - M[...,2,0], M[...,0,1] + M[...,1,0], 1 - m00 + m11 - m22, M[...,1,2] + M[...,2,1] ),
+                            ( M[...,1,0] - M[...,0,1], M[...,0,2] + M[...,2,0], M[...,1,2] + M[...,2,1], 1 - m00 - m11 + m22 ) ))
+    choice = np.argmax( np.array(( trace, m00, m11, m22 )), axis=0 )
+    q = np.moveaxis( np.choose( choice, candidates ), 0, -1 )
+    q = normalize( q )
+    return np.where( q[...,0:1] < 0, -q, q )
+
+
+def slerp( p, q, t, shortest = True ):
+    """Spherical linear interpolation between unit quaternions p and q.
+
+    Arguments: (p, q, t)
+    p, q -- 4-element quaternions, or N x 4 arrays of quaternions
+    t    -- interpolation parameter from 0 (p) to 1 (q), a scalar or N-element array
+
+    Optional arguments:
+    shortest -- if true (the default), follow the shorter arc
+
+    The arguments are broadcast together, so N pairs of quaternions can be
+    interpolated in one call.  To follow the shorter arc, q is negated where
+    it lies in the opposite hemisphere from p.  Nearly identical quaternions
+    are interpolated linearly to avoid dividing by a vanishing sine.
+    """
+    p = np.asarray( p, dtype=float )
+    q = np.asarray( q, dtype=float )
+    t = np.asarray( t, dtype=float )[...,np.newaxis]
+
+    dot = np.sum( p * q, axis=-1 )[...,np.newaxis]
+    if shortest:
+        q = np.where( dot < 0, -q, q )
+        dot = np.abs( dot )
+    dot = np.clip( dot, -1.0, 1.0 )
+
+    angle = np.arccos( dot )
+    sine = np.sin( angle )
+    small = sine < 1e-6
+    safe = np.where( small, 1.0, sine )
+    a = np.where( small, 1.0 - t, np.sin( (1.0 - t) * angle ) / safe )
+    b = np.where( small, t, np.sin( t * angle ) / safe )
+    r = a * p + b * q
+    return r / np.sqrt( np.sum( r * r, axis=-1 ))[...,np.newaxis]
+
+
+def log( q ):
+    """Return the logarithm of a unit quaternion, a pure quaternion (0, v) with |v| half the rotation angle.
+
+    Accepts a single quaternion or an N x 4 array.
+    """
+    q = np.asarray( q, dtype=float )
+    vnorm = np.sqrt( np.sum( q[...,1:4] * q[...,1:4], axis=-1 ))
+    angle = np.arctan2( vnorm, q[...,0] )
+    scale = np.where( vnorm < 1e-12, 1.0, angle / np.where( vnorm < 1e-12, 1.0, vnorm ))
+    return vector( scale[...,np.newaxis] * q[...,1:4] )
+
+
+def exp( q ):
+    """Return the exponential of a pure quaternion (0, v), the inverse of log.
+
+    Accepts a single quaternion or an N x 4 array.
+    """
+    q = np.asarray( q, dtype=float )
+    angle = np.sqrt( np.sum( q[...,1:4] * q[...,1:4], axis=-1 ))
+    scale = np.where( angle < 1e-12, 1.0, np.sin( angle ) / np.where( angle < 1e-12, 1.0, angle ))
+    return np.concatenate(( np.cos( angle )[...,np.newaxis], scale[...,np.newaxis] * q[...,1:4] ), axis=-1 )
+
+
+def unwrap( q ):
+    """Return a copy of an N x 4 quaternion sequence with signs chosen for hemisphere continuity.
+
+    A quaternion and its negative represent the same rotation, but motion
+    capture data and conversions can flip between them from one sample to
+    the next.  Each quaternion is negated as needed so that it lies in the
+    same hemisphere as its predecessor, i.e. their dot product is not
+    negative, which interpolation and filtering of the components require.
+    """
+    q = np.asarray( q, dtype=float )
+    if len(q) < 2:
+        return q.copy()
+    flips = np.sum( q[1:] * q[:-1], axis=1 ) < 0
+    sign = np.concatenate(( [1.0], np.where( np.cumsum( flips ) % 2 == 1, -1.0, 1.0 )))
+    return q * sign[:,np.newaxis]
+
+
+def squad_controls( q ):
+    """Return the inner control quaternions for squad interpolation of an N x 4 sequence.
+
+    The sequence should be unwrapped first.  Each control point is
+    s_i = q_i exp( -(log(q_i* q_i+1) + log(q_i* q_i-1)) / 4 ), with the end
+    points repeated at the ends of the sequence.
+    """
+    q = np.asarray( q, dtype=float )
+    preceding = np.concatenate(( q[:1], q[:-1] ))
+    following = np.concatenate(( q[1:], q[-1:] ))
+    qinv = conjugate( q )
+    tangent = log( multiply( qinv, following )) + log( multiply( qinv, preceding ))
+    return multiply( q, exp( -0.25 * tangent ))
+
+
+def squad( p, a, b, q, t ):
+    """Spherical cubic interpolation between p and q with inner control points a and b.
+
+    Arguments: (p, a, b, q, t)
+    p, q -- end quaternions, 4-element or N x 4 arrays
+    a, b -- inner control quaternions for p and q, e.g. from squad_controls
+    t    -- interpolation parameter from 0 (p) to 1 (q), a scalar or N-element array
+
+    Unlike slerp this gives a rotation path with a continuous angular velocity
+    through a sequence of keyframes.
+    """
+    t = np.asarray( t, dtype=float )
+    return slerp( slerp( p, q, t, shortest = False ), slerp( a, b, t, shortest = False ), 2 * t * (1 - t), shortest = False )
+
+
+def interpolate( times, q, t, method = 'slerp' ):
+    """Interpolate a sampled quaternion trajectory at arbitrary times.
+
+    Arguments: (times, q, t)
+    times -- N-element array of increasing sample times
+    q     -- N x 4 array of unit quaternions
+    t     -- scalar or M-element array of query times; times outside the samples are clamped
 
+    Optional arguments:
+    method -- 'slerp' for piecewise spherical linear interpolation, or 'squad' for a smooth spline
+
+    Returns a quaternion, or an M x 4 array of quaternions, all located with
+    a single search over the sample times.
+    """
+    times = np.asarray( times, dtype=float )
+    q = unwrap( q )
+    t = np.asarray( t, dtype=float )
+    if len(times) == 1:
+        return np.broadcast_to( q[0], t.shape + (4,) ).copy()
+
+    i = np.clip( np.searchsorted( times, t, side='right' ) - 1, 0, len(times) - 2 )
+    interval = times[i+1] - times[i]
+    u = np.clip( (t - times[i]) / np.where( interval > 0, interval, 1.0 ), 0.0, 1.0 )
+
+    if method == 'slerp':
+        return slerp( q[i], q[i+1], u )
+    elif method == 'squad':
+        s = squad_controls( q )
+        return normalize( squad( q[i], s[i], s[i+1], q[i+1], u ))
+    else:
+        raise ValueError( "Unknown interpolation method: %s" % method )
+
+
+def average( q, weights = None ):
+    """Return the average rotation of an N x 4 array of unit quaternions.
+
+    Optional arguments:
+    weights -- N-element array of non-negative weights, default is uniform
+
+    This uses the method of Markley et al. (2007): the average is the
+    eigenvector with the largest eigenvalue of the weighted sum of the outer
+    products q q^T.  Unlike normalizing the mean of the components, this is
+    unaffected by the sign of each quaternion and remains accurate for
+    widely spread rotations.  The result is returned in the hemisphere with
+    a non-negative scalar part.
+    """
+    q = np.asarray( q, dtype=float )
+    if weights is None:
+        M = np.dot( q.T, q )
+    else:
+        M = np.dot( q.T * np.asarray( weights, dtype=float ), q )
+    values, vectors = np.linalg.eigh( M )
+    result = vectors[:,-1]
+    return -result if result[0] < 0 else result
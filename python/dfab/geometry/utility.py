@@ -22,11 +22,25 @@ def xyzw_to_wxyz( q ):
 # ==================================================================
 
 def pos_quat_to_threexform( x, q ):
-    """Generate a homogeneous transform from a position vector and a quaternion."""
+    """Generate a homogeneous transform from a position vector and a quaternion.
+
+    Arguments:
+    x -- 3-element position vector, or N x 3 array of positions
+    q -- 4-element (w,x,y,z) quaternion, or N x 4 array of quaternions
+
+    Returns a 4x4 transform, or an N x 4 x 4 array of transforms for array arguments.
+    """
     tq = quat.to_threexform( q )
-    tq[0:3,3] = x  # directly set the translation vector portion of the transform
+    tq[...,0:3,3] = x  # directly set the translation vector portion of the transform
     return tq
 
+def transform_threexforms( T, frames ):
+    """Premultiply every transform in an N x 4 x 4 array by a single 4x4 transform T.
+
+    This is equivalent to [np.dot(T, f) for f in frames] as a single array operation.
+    """
+    return np.einsum( 'ij,njk->nik', T, frames )
+
 
 def pos_ypr_to_threexform( x, ypr ):
     """Generate a homogeneous transform from a position vector and a (yaw, pitch, roll) triple.
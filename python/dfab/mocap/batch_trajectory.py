@@ -0,0 +1,214 @@
+"""Process many Optitrack motion capture .csv files into world-frame trajectories using a pool of worker processes.
+
+Copyright (c) 2014, Garth Zeglin.  All rights reserved. Licensed under the terms
+of the BSD 3-clause license as included in LICENSE.
+
+This is the back end of the batch_trajectory_from_mocap script.  Each job
+extracts one body from one CSV file using
+dfab.mocap.extract_trajectory.process_trajectory.  The jobs for one CSV file
+are run together by a single worker, which loads the file once for all of
+its bodies.  A job is skipped if its
+output file is newer than both its CSV file and its parameter file, and each
+output is written to a temporary file and renamed when complete, so an
+interrupted batch can simply be run again to resume.
+"""
+
+import os
+import sys
+import time
+import argparse
+import traceback
+import multiprocessing
+import dfab.mocap.datafiles as datafiles
+import dfab.mocap.extract_trajectory
+
+# file name patterns recognized as Optitrack CSV files when scanning a directory
+CSV_EXTENSIONS = ('.csv', '.csv.gz', '.csv.bz2', '.csv.xz')
+
+# ==================================================================
+def output_name( csv, body, output_dir = None ):
+    """Return the default trajectory file name for a body extracted from a CSV file.
+
+    The name is the CSV file name without the extension, followed by the body
+    name with spaces replaced, e.g. 'capture-Small_Tool.traj'.  The file is
+    placed beside the CSV file unless output_dir is given.
+    """
+    base = os.path.basename( csv )
+    for ext in CSV_EXTENSIONS:
+        if base.lower().endswith( ext ):
+            base = base[:-len(ext)]
+            break
+    name = "%s-%s.traj" % (base, body.replace(' ', '_'))
+    return os.path.join( output_dir if output_dir is not None else os.path.dirname( csv ), name )
+
+def make_job( csv, body, param, output = None, output_dir = None, rate = 12, stream = False, cache = True ):
+    """Return a job dictionary for extracting one body from one CSV file."""
+    if output is None:
+        output = output_name( csv, body, output_dir )
+    return { 'csv' : csv, 'body' : body, 'param' : param, 'output' : output,
+             'rate' : rate, 'stream' : stream, 'cache' : cache }
+
+def directory_jobs( directory, bodies, param, output_dir = None, rate = 12, stream = False, cache = True ):
+    """Return a list of jobs extracting each of the named bodies from every CSV file in a directory."""
+    names = sorted( name for name in os.listdir( directory ) if name.lower().endswith( CSV_EXTENSIONS ))
+    return [ make_job( os.path.join( directory, name ), body, param, output_dir = output_dir, rate = rate, stream = stream, cache = cache )
+             for name in names for body in bodies ]
+
+def manifest_jobs( manifest, param = None, output_dir = None, rate = 12, stream = False, cache = True ):
+    """Return the list of jobs specified in a JSON manifest file.
+
+    The manifest is a list of objects, each with 'csv' and 'body' entries and
+    optional 'param', 'output', and 'rate' entries.  Relative paths are
+    interpreted relative to the directory containing the manifest.  A job
+    without a 'param' entry uses the given default parameter file.
+    """
+    root = os.path.dirname( os.path.abspath( manifest ))
+    def path( name ):
+        return None if name is None else os.path.join( root, name )
+
+    jobs = []
+    for entry in datafiles.read_parameter_file( manifest ):
+        job_param = path( entry.get( 'param' )) or param
+        if job_param is None:
+            raise ValueError( "Manifest entry for %s has no parameter file." % entry['csv'] )
+        jobs.append( make_job( path( entry['csv'] ), entry['body'], job_param, output = path( entry.get( 'output' )),
+                               output_dir = output_dir, rate = entry.get( 'rate', rate ), stream = stream, cache = cache ))
+    return jobs
+
+# ==================================================================
+def up_to_date( job ):
+    """Return True if the output of a job exists and is newer than its inputs.
+
+    A job with a missing input is not up to date, so that it is run and its
+    failure recorded.
+    """
+    try:
+        return os.path.getmtime( job['output'] ) >= max( os.path.getmtime( job['csv'] ), os.path.getmtime( job['param'] ))
+    except OSError:
+        return False
+
+def run_job( job, data = None ):
+    """Run a single job, returning a result dictionary with the status and elapsed time.
+
+    Errors are recorded in the result rather than raised so that one bad
+    capture does not stop the batch.  The trajectory is written to a
+    temporary file which is renamed only after it is complete.
+
+    Optional arguments:
+    data -- the Run already loaded from the CSV file, see run_group
+    """
+    result = dict( job )
+    start = time.time()
+    if up_to_date( job ):
+        result.update( status = 'skipped', seconds = 0.0, error = None )
+        return result
+
+    temporary = job['output'] + '.partial'
+    args = argparse.Namespace( param = job['param'], csv = job['csv'], body = job['body'], rate = job['rate'],
+                               output = temporary, verbose = False, stream = job['stream'], cache = job['cache'], jobs = 1 )
+    try:
+        dfab.mocap.extract_trajectory.process_trajectory( args, data )
+        if os.path.exists( job['output'] ):
+            os.remove( job['output'] )
+        os.rename( temporary, job['output'] )
+        result.update( status = 'done', error = None )
+    except Exception:
+        if os.path.exists( temporary ):
+            os.remove( temporary )
+        result.update( status = 'failed', error = traceback.format_exc().strip().splitlines()[-1] )
+
+    result['seconds'] = time.time() - start
+    return result
+
+def run_group( jobs ):
+    """Run the jobs for a single CSV file, returning the list of result dictionaries.
+
+    This is the worker function for process_batch.  Unless the jobs stream
+    the file, it is loaded once with all the bodies needed by the jobs which
+    are not up to date, so the file is parsed and its cache written only
+    once.  If that load fails, e.g. for a body missing from the file, each
+    job loads the file itself so the error is recorded against that job.
+    """
+    pending = [ job for job in jobs if not up_to_date( job ) ]
+    data = None
+    if pending and not any( job['stream'] for job in pending ):
+        bodies = []
+        for job in pending:
+            if job['body'] not in bodies:
+                bodies.append( job['body'] )
+        start = time.time()
+        try:
+            data = dfab.mocap.extract_trajectory.load_csv_data( jobs[0]['csv'], bodies = bodies, markers = False, cache = pending[0]['cache'] )
+        except Exception:
+            data = None
+        load_seconds = time.time() - start
+
+    results = [ run_job( job, data ) for job in jobs ]
+    if data is not None:
+        # charge the shared load to the first job which used it
+        results[jobs.index( pending[0] )]['seconds'] += load_seconds
+    return results
+
+def group_jobs( jobs ):
+    """Return a list of lists of jobs, one for each CSV file, in the order the files first appear."""
+    groups = {}
+    order = []
+    for job in jobs:
+        if job['csv'] not in groups:
+            groups[job['csv']] = []
+            order.append( job['csv'] )
+        groups[job['csv']].append( job )
+    return [ groups[csv] for csv in order ]
+
+def process_batch( jobs, processes = None, verbose = False ):
+    """Run a list of jobs across a pool of worker processes.
+
+    The jobs are grouped by CSV file, and each group is run by one worker
+    using run_group.  Returns the list of result dictionaries in the order
+    the jobs completed.  If the batch is interrupted, the results of the
+    completed groups are returned.
+
+    Optional arguments:
+    processes -- the number of worker processes, default is the number of CPUs
+    verbose -- true to print each result as it completes
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    results = []
+    pool = multiprocessing.Pool( processes )
+    try:
+        for group in pool.imap_unordered( run_group, group_jobs( jobs )):
+            for result in group:
+                if verbose: print "%-7s %7.2f s  %s [%s]" % (result['status'], result['seconds'], result['csv'], result['body'])
+                results.append( result )
+        pool.close()
+    except KeyboardInterrupt:
+        print "Interrupted; completed outputs are kept and the batch may be run again to resume."
+        pool.terminate()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def write_summary( filename, results, elapsed ):
+    """Write a JSON summary of a batch including the timing and any error for each job."""
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get( result['status'], 0 ) + 1
+    datafiles.write_parameter_file( filename, { 'elapsed' : elapsed, 'counts' : counts, 'jobs' : results } )
+
+def print_summary( results, elapsed, stream = sys.stdout ):
+    """Print a table of job results followed by the totals."""
+    for result in results:
+        stream.write( "%-7s %7.2f s  %s [%s]\n" % (result['status'], result['seconds'], result['csv'], result['body'] ))
+        if result['error'] is not None:
+            stream.write( "        %s\n" % result['error'] )
+    done = sum( 1 for r in results if r['status'] == 'done' )
+    skipped = sum( 1 for r in results if r['status'] == 'skipped' )
+    failed = len( results ) - done - skipped
+    stream.write( "%d done, %d up to date, %d failed in %.1f seconds.\n" % (done, skipped, failed, elapsed ))
+
+#================================================================
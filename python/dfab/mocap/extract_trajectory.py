@@ -22,15 +22,15 @@ import dfab.geometry
 np.set_printoptions(suppress=True, precision=8)
 
 # ==================================================================
-def load_csv_data( filename, verbose = False ):
+def load_csv_data( filename, verbose = False, bodies = None, markers = True, cache = True, processes = 1 ):
     if verbose: print "Loading", filename
-    data = optitrack.Run().ReadFile( data_dir = ".", filename = filename, verbose = False )
+    data = optitrack.Run().ReadFile( data_dir = ".", filename = filename, verbose = False, columnar = True, bodies = bodies, markers = markers, cache = cache, processes = processes )
     if verbose: print "Found %d rigid bodies, %d frames." % (data.trackablecount, data.framecount )
     if verbose: print "Bodies:",[body.name for body in data.trackables]
     return data
 
 # ==================================================================
-def extract_trajectory( data, subsampling_ratio = 12, body = 'Tool', verbose = False ):
+def extract_trajectory( data, subsampling_ratio = 12, body = 'Tool', verbose = False, hz = None, max_gap = 0.1 ):
     """Transform a sequence of mocap body frames into a world-frame trajectory.
 
     The position data is converted from meters to millimeters.
@@ -39,32 +39,233 @@ def extract_trajectory( data, subsampling_ratio = 12, body = 'Tool', verbose = F
     subsampling_ratio -- the ratio of frames to frames processed, default is 12 for 10Hz samples
     body -- the name of the desired body in the mocap dataset
     verbose -- true for more console output
+    hz -- if given, resample to this output rate in Hz using resample_trajectory instead of subsampling
+    max_gap -- the longest interval in seconds without the body which is filled when resampling
     """
 
     # Extract three lists of vectors defining the tool motion:
     # timestamps, positions, and orientation quaternions.
     times, x_tool, q_tool, ypr_tool = data.trajectory( body )
 
-    # use a Python slice with a step index to subsample the input.
-    times     = times[::subsampling_ratio]
-    x_tool    = x_tool[::subsampling_ratio]
-    q_tool    = q_tool[::subsampling_ratio]
-    ypr_tool  = ypr_tool[::subsampling_ratio]
+    if hz is None:
+        # use a Python slice with a step index to subsample the input.
+        times     = times[::subsampling_ratio]
+        x_tool    = x_tool[::subsampling_ratio]
+        q_tool    = q_tool[::subsampling_ratio]
+        ypr_tool  = ypr_tool[::subsampling_ratio]
 
+    x_tool, q_tool = convert_mocap_units( x_tool, q_tool )
+
+    if hz is not None:
+        times, x_tool, q_tool, ypr_tool = resample_trajectory( times, x_tool, q_tool, ypr_tool, hz, max_gap = max_gap )
+
+    if verbose: print "Found %d samples for body %s." % (len(times), body )
+    return times, x_tool, q_tool, ypr_tool
+
+# ==================================================================
+def stream_trajectory( filename, subsampling_ratio = 12, body = 'Tool', chunk = 1200, verbose = False, hz = None, max_gap = 0.1 ):
+    """Extract a body trajectory from a CSV file by streaming it in blocks of frames.
+
+    This produces the same result as load_csv_data followed by
+    extract_trajectory, but only a single block of frames is held in memory at
+    a time, so it can process captures larger than the available RAM.
+
+    Optional arguments:
+    subsampling_ratio -- the ratio of frames to frames processed, default is 12 for 10Hz samples
+    body -- the name of the desired body in the mocap dataset
+    chunk -- the number of frames to parse in each block
+    verbose -- true for more console output
+    hz -- if given, resample to this output rate in Hz using resample_trajectory instead of subsampling
+    max_gap -- the longest interval in seconds without the body which is filled when resampling
+
+    This is implemented as a dfab.mocap.pipeline.Pipeline; resampling
+    proceeds block by block, so its results may differ from resampling the
+    whole trajectory at once by rounding error.
+    """
+    import dfab.mocap.pipeline as pipeline
+    if verbose: print "Streaming", filename
+
+    source = pipeline.CSVSource( filename, bodies = [body], chunk = chunk )
+    stages = [ pipeline.BodySelect( source.run, body ),
+               pipeline.Subsample( subsampling_ratio ) if hz is None else pipeline.Resample( hz, max_gap = max_gap ) ]
+    result = pipeline.Pipeline( source, stages, pipeline.ArraySink() ).run().result()
+    times, x_tool, q_tool, ypr_tool = result.times, result.x, result.q, result.ypr
+
+    if verbose: print "Found %d samples for body %s." % (len(times), body )
+    return times, x_tool, q_tool, ypr_tool
+
+# ==================================================================
+def convert_mocap_units( x_tool, q_tool ):
+    """Convert mocap position and quaternion arrays to the conventions of the robot and quaternion code.
+
+    Returns a new (x_tool, q_tool) pair of N x 3 and N x 4 arrays.
+    """
     # Convert from the mocap default meter coordinates to millimeters
     # for consistency with the ABB robot.
-    x_tool *= 1000
+    x_tool = x_tool * 1000
 
     # Convert the (x, y, z, w) quaternions returned by the mocap system to (w,x,y,z)
     # order as used by the quaternion code.
     q_tool = dfab.geometry.xyzw_to_wxyz(q_tool)
+    return x_tool, q_tool
 
-    if verbose: print "Found %d samples for body %s." % (len(times), body )
-    return times, x_tool, q_tool, ypr_tool
+# ==================================================================
+def resample_trajectory( times, x_tool, q_tool, ypr_tool, hz, max_gap = 0.1, cutoff = None, dt = None ):
+    """Resample a body trajectory at the multiples of 1/hz seconds.
+
+    Unlike subsampling by a fixed ratio, this produces samples at exact output
+    times regardless of jitter or dropped frames in the capture:
+
+    - positions are low-pass filtered to avoid aliasing, then interpolated linearly
+    - orientations are interpolated with spherical linear interpolation (SLERP)
+    - yaw-pitch-roll angles are unwrapped and interpolated linearly
+    - gaps where the body was missing are filled if they are no longer than
+      max_gap seconds; no output is produced within longer gaps
+
+    The positions are filtered with a Gaussian kernel on a uniform grid at the
+    median capture interval, separately within each section between long
+    gaps.  The kernel width places the half-power frequency at the cutoff.
+
+    Arguments:
+    times, x_tool, q_tool, ypr_tool -- N-element timestamps and N x 3, N x 4, N x 3 sample arrays
+    hz -- output sample rate in Hz
+
+    Optional arguments:
+    max_gap -- the longest interval in seconds between samples which is interpolated
+    cutoff -- low-pass cutoff frequency in Hz, default is half the output rate; 0 disables the filter
+    dt -- capture interval in seconds for the filter grid, default is the median sample interval
+
+    Returns a new (times, x_tool, q_tool, ypr_tool) tuple.
+    """
+    # ignore any samples with missing values
+    valid = ~( np.isnan( x_tool ).any( axis=1 ) | np.isnan( q_tool ).any( axis=1 ))
+    times, x_tool, q_tool, ypr_tool = times[valid], x_tool[valid], q_tool[valid], ypr_tool[valid]
+    if len(times) < 2:
+        return times, x_tool, q_tool, ypr_tool
+
+    # Choose the output times within the capture, then keep those which fall
+    # on a sample or within a short enough interval between samples.
+    out_times = np.arange( np.ceil( times[0] * hz ), np.floor( times[-1] * hz ) + 1 ) / hz
+    i = np.clip( np.searchsorted( times, out_times, side='right' ) - 1, 0, len(times) - 2 )
+    interval = times[i+1] - times[i]
+    keep = (interval <= max_gap) | (out_times == times[i]) | (out_times == times[i+1])
+    out_times, i, interval = out_times[keep], i[keep], interval[keep]
+    u = np.clip( (out_times - times[i]) / np.where( interval > 0, interval, 1.0 ), 0.0, 1.0 )
+
+    # low-pass filter the positions within each section between long gaps
+    if dt is None:
+        dt = np.median( np.diff( times ))
+    if cutoff is None:
+        cutoff = 0.5 * hz
+    if cutoff > 0 and cutoff < 0.5 / dt:
+        x_tool = lowpass_positions( times, x_tool, dt, cutoff, max_gap )
+
+    x_out = x_tool[i] + u[:,np.newaxis] * (x_tool[i+1] - x_tool[i])
+    q_out = quat.slerp( q_tool[i], q_tool[i+1], u )
+
+    ypr = np.unwrap( np.radians( ypr_tool ), axis=0 )
+    ypr = ypr[i] + u[:,np.newaxis] * (ypr[i+1] - ypr[i])
+    ypr_out = np.degrees( np.arctan2( np.sin( ypr ), np.cos( ypr )))
+
+    return out_times, x_out, q_out, ypr_out
+
+def lowpass_positions( times, x, dt, cutoff, max_gap ):
+    """Apply a zero-phase Gaussian low-pass filter to irregularly sampled positions.
+
+    The positions within each section between gaps longer than max_gap are
+    interpolated onto a uniform grid with spacing dt, convolved with a Gaussian
+    kernel with its half-power point at the cutoff frequency, and sampled back
+    at the original times.  Each section is extended by odd reflection at both
+    ends so that steady motion is not biased near a gap.  Returns a new N x 3
+    array.
+    """
+    sigma = np.sqrt( np.log(2) ) / (2 * np.pi * cutoff * dt)   # kernel width in grid samples
+    half = int( np.ceil( 3 * sigma ))
+    kernel = np.exp( -0.5 * (np.arange( -half, half + 1 ) / sigma) ** 2 )
+    kernel /= kernel.sum()
+
+    filtered = np.empty_like( x )
+    breaks = np.flatnonzero( np.diff( times ) > max_gap ) + 1
+    for start, end in zip( np.r_[0, breaks], np.r_[breaks, len(times)] ):
+        t = times[start:end]
+        grid = t[0] + dt * np.arange( int( np.floor( (t[-1] - t[0]) / dt )) + 2 )
+        for axis in range(3):
+            samples = np.pad( np.interp( grid, t, x[start:end, axis] ), half, mode='reflect', reflect_type='odd' )
+            smooth = np.convolve( samples, kernel, mode='valid' )
+            filtered[start:end, axis] = np.interp( t, grid, smooth )
+    return filtered
+
+# ==================================================================
+def simplify_trajectory( times, x_tool, q_tool, tolerance = 1.0, angle_tolerance = 1.0 ):
+    """Select a subset of trajectory samples which reproduces the path within position and orientation tolerances.
+
+    This is the Ramer-Douglas-Peucker algorithm generalized to rigid body
+    poses.  The path between two retained samples is taken to be the linear
+    interpolation of position and the SLERP of orientation over time; a
+    segment is split at the intermediate sample with the largest deviation
+    from that path until every sample is within both tolerances.  The
+    deviations for a whole segment are computed as array operations.
+
+    Since the deviations are distances and rotation angles, the result is
+    unchanged by the rigid mocap-to-world calibration transform, so this can
+    be applied before or after calibration.
+
+    Arguments:
+    times, x_tool, q_tool -- N-element timestamps, N x 3 positions, and N x 4 (w,x,y,z) quaternions
+
+    Optional arguments:
+    tolerance -- maximum position deviation, in the units of x_tool (default 1.0)
+    angle_tolerance -- maximum orientation deviation in degrees (default 1.0)
+
+    Returns an array of the indices of the retained samples, always including the first and last.
+    """
+    count = len(times)
+    if count < 3:
+        return np.arange( count )
+
+    keep = np.zeros( count, dtype=bool )
+    keep[0] = keep[-1] = True
+    angle_tolerance = np.radians( angle_tolerance )
+
+    segments = [ (0, count - 1) ]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+
+        span = times[last] - times[first]
+        k = np.arange( first + 1, last )
+        u = (times[k] - times[first]) / span if span > 0 else np.linspace( 0, 1, last - first + 1 )[1:-1]
+
+        # deviations from the interpolated pose, each scaled by its tolerance
+        path = x_tool[first] + u[:,np.newaxis] * (x_tool[last] - x_tool[first])
+        position_error = np.sqrt( np.sum( (x_tool[k] - path) ** 2, axis=1 )) / tolerance
+        dot = np.abs( np.sum( q_tool[k] * quat.slerp( q_tool[first], q_tool[last], u ), axis=1 ))
+        angle_error = 2 * np.arccos( np.minimum( dot, 1.0 )) / angle_tolerance
+
+        error = np.maximum( position_error, angle_error )
+        worst = np.argmax( error )
+        if error[worst] > 1.0:
+            split = first + 1 + worst
+            keep[split] = True
+            segments.append( (first, split) )
+            segments.append( (split, last) )
+
+    return np.flatnonzero( keep )
 
 #================================================================
-def process_trajectory( args ):
-    """Process a CSV file into a trajectory file."""
+def process_trajectory( args, data = None ):
+    """Process a CSV file into a trajectory file.
+
+    The work is performed by the pipeline returned by build_pipeline; the
+    sink is returned, e.g. with the number of samples written as sink.count.
+
+    If args.profile is 'text' or 'json', the performance of each pipeline
+    stage is printed in that format once complete.
+
+    Optional arguments:
+    data -- a Run already loaded from args.csv in columnar mode, including args.body, to use instead of loading the file
+    """
 
     # Read the parameter file and retrieve the mocap calibration matrix.
     try:
@@ -77,36 +278,74 @@ def process_trajectory( args ):
             "relationship between the motion capture coordinates and robot coordinates."
         raise
 
-    # Extract a single trajectory from the CSV file in mocap coordinates.
+    import dfab.mocap.pipeline as pipeline
+    profile = pipeline.Profile() if getattr( args, 'profile', None ) else None
+
     try:
-        data = load_csv_data( args.csv, verbose = args.verbose )
+        process = build_pipeline( args, mocap_to_world, profile, data )
     except:
         print "Unable to load CSV file: " + str(traceback.format_exc()) + \
             "\nThe script was unable to load the Optitrack CSV file.  The CSV " +\
             "is the complete motion capture data saved from the Optitrack Motive software."
         raise
 
+    if args.verbose: print "Applying mocap calibration matrix:\n", mocap_to_world
+    if args.verbose and args.output is not None: print "Generating trajectory file", args.output
     try:
-        times, x_tool, q_tool, ypr_tool = extract_trajectory( data, subsampling_ratio = args.rate, body = args.body, verbose = args.verbose )
+        sink = process.run()
     except:
         print "Unable to extract trajectory: " + str(traceback.format_exc()) + \
             "\nThe script was unable to extract body " + args.body + " from the Optitrack CSV file."
         raise
 
+    if args.verbose: print "Produced %d samples for body %s." % (sink.count, args.body )
 
-    # Generate a homogeneous transform representing each tool frame.
-    tool_traj = [ dfab.geometry.pos_quat_to_threexform( position, orientation ) for (position, orientation) in zip( x_tool, q_tool) ]
-    
-    # Compute the tool trajectory as expressed in the world frame. 
-    if args.verbose: print "Applying mocap calibration matrix:\n", mocap_to_world
-    tool_traj_world = [np.dot( mocap_to_world, ti) for ti in tool_traj]
+    if profile is not None:
+        if args.profile == 'json':
+            print json.dumps( profile.as_dict(), indent = 1 )
+        else:
+            print profile.report()
+    return sink
+
+def build_pipeline( args, mocap_to_world, profile = None, data = None ):
+    """Construct the dfab.mocap.pipeline.Pipeline which converts a CSV file into a world-frame trajectory.
 
-    # ==================================================================
-    if args.output is not None:
-        if args.verbose: print "Generating trajectory file", args.output
-        datafiles.write_frame_trajectory_file( args.output, times, tool_traj_world )
+    The stages are selected by the same attributes used by process_trajectory:
+    the CSV file is streamed in blocks if args.stream is set, else loaded
+    completely (using the binary cache and worker processes as configured);
+    the body samples are then subsampled by args.rate or resampled at args.hz,
+    transformed by mocap_to_world, optionally simplified to args.tolerance, and
+    written to args.output or printed if it is None.  Attributes other than
+    body, csv, output, rate, and verbose are optional.
+
+    If a dfab.mocap.pipeline.Profile is given, the pipeline records its
+    performance there, including the complete load as 'load'.  If a loaded
+    Run is given as data, it is used as the source instead.
+    """
+    import dfab.mocap.pipeline as pipeline
+
+    if data is not None:
+        source = pipeline.RunSource( data )
+    elif getattr( args, 'stream', False ):
+        source = pipeline.CSVSource( args.csv, bodies = [args.body] )
+    else:
+        load_args = dict( verbose = args.verbose, bodies = [args.body], markers = False, cache = getattr( args, 'cache', True ), processes = getattr( args, 'jobs', 1 ))
+        if profile is not None:
+            data = profile.measure( 'load', load_csv_data, args.csv, **load_args )
+        else:
+            data = load_csv_data( args.csv, **load_args )
+        source = pipeline.RunSource( data )
+
+    stages = [ pipeline.BodySelect( source.run, args.body ) ]
+    if getattr( args, 'hz', None ) is None:
+        stages.append( pipeline.Subsample( args.rate ))
     else:
-        print "Trajectory:"
-        for m in tool_traj_world: print m
+        stages.append( pipeline.Resample( args.hz, max_gap = getattr( args, 'max_gap', 0.1 )))
+    stages.append( pipeline.Calibrate( mocap_to_world ))
+    if getattr( args, 'tolerance', None ) is not None:
+        stages.append( pipeline.Simplify( args.tolerance, getattr( args, 'angle_tolerance', 1.0 )))
+
+    sink = pipeline.FrameTrajectorySink( args.output ) if args.output is not None else pipeline.PrintSink()
+    return pipeline.Pipeline( source, stages, sink, profile )
 
 #================================================================
@@ -51,21 +51,44 @@ The original version was downloaded from github using the following:
 
 import os
 import csv
+import json
+import array
+import shutil
+import hashlib
+import time
+import multiprocessing
 import numpy as np
+import dfab.mocap.datafiles as datafiles
 
 TSL = 11        # trackable state vector length
 MSL = 5         # marker state vector
+SVL = TSL - 1   # columnar state vector length (the state fields without the ID)
 
 bad = '#'
 
+CACHE_SUFFIX = '.dfabcache'     # name suffix of the binary cache directory beside a CSV file
+CACHE_VERSION = 4               # incremented whenever the cached array layout changes
+CACHE_HASH_BYTES = 1 << 20      # size of the head and tail blocks hashed to identify the file contents
+
+INDEX_SUFFIX = '.dfabindex.npz' # name suffix of the frame offset index file beside a CSV file
+INDEX_STRIDE = 1200             # default number of frames between frame offset index entries
+INDEX_BLOCK_BYTES = 1 << 24     # size of the blocks read while scanning for frame rows
+
 ################################################################
 class Run():
     """Represents a motion capture run as a collection of frame objects holding the complete state at each time sample.
 
+    A run may also be loaded in columnar mode, in which the frame data is
+    parsed directly into a FrameArrays object instead of per-frame objects.
+    This is much faster and more compact for long captures.  In this mode
+    frames is a FrameList which creates FrameProxy objects on access.
+
     Object attributes:
     trackables         list of Trackable objects with rigid body definitions
     frames             list of Frame objects with motion capture body and marker positions
+    body_index         dictionary mapping each body ID to a (frame indices, state positions) pair of arrays locating its states in frames
     trackable_frames   list of TrackableFrame objects with extended data on frame
+    arrays             FrameArrays object holding the frame data in columnar mode, else None
     coord_type         coordinate system convention, either 'left' or 'right'
     framecount         the number of frames present in file
     trackablecount     the number of rigid bodies represented in file
@@ -75,6 +98,8 @@ class Run():
         self.trackables = []
         self.frames = []
         self.trackable_frames = []
+        self.arrays = None
+        self.body_index = {}
         self.coord_type = 'right'
         self.framecount = 0
         self.trackablecount = 0
@@ -111,28 +136,65 @@ class Run():
         self.trackables.append(trackable)
 
       tr = self.trackables[ids.index(id)]
-      N = len(self.frames)
+      M = tr.num_markers
+
+      if self.arrays is not None:
+        t, d = self.arrays.trk(id, M)
+      else:
+        N = len(self.frames)
+        t = np.nan*np.zeros(N)
+        d = np.nan*np.zeros((N,M,3))
+
+        for f in self.trackable_frames:
+          if f.id == id and f.index < N:
+            j = f.index
+            t[j] = f.timestamp
+            if len(f.ptcld_markers) == M:
+              d[j,:,:] = [m.pos.toArray() for m in f.ptcld_markers]
+
+      #for now ignore all non perfect data
+      d[np.isnan(d).any(axis=(1,2))] = np.nan
+      return t,d
 
-      #TODO make this not depend on the first frame
-      M = len(self.trackable_frames[0].ptcld_markers) #get the length from the first frame
+    #---------------------------------------------------------------
+    def marker_quality(self, name):
+      """
+      t,tracked,quality,error = marker_quality(name)
 
-      t = np.nan*np.zeros(N)
-      d = np.nan*np.zeros((N,M,3))
+      Return the per-marker tracking quality for a rigid body from the extended
+      rigid body records.  This requires loading with extended=True.
 
+      t - 1 x N - timestamp for N frames, NaN where there is no record
+      tracked - N x M - boolean tracked flags for M markers in N frames
+      quality - N x M - marker quality for M markers in N frames
+      error - 1 x N - mean marker error for N frames
+      """
+      names = [t.name for t in self.trackables]
+      tr = self.trackables[names.index(name)]
+      M = tr.num_markers
+
+      if self.arrays is not None:
+        return self.arrays.marker_quality(tr.id, M)
+
+      N = len(self.frames)
+      t = np.nan*np.zeros(N)
+      tracked = np.zeros((N,M), dtype=bool)
+      quality = np.nan*np.zeros((N,M))
+      error = np.nan*np.zeros(N)
       for f in self.trackable_frames:
-        if f.id == id:
+        if f.id == tr.id and f.index < N:
           j = f.index
           t[j] = f.timestamp
-
-          data = np.asarray([m.pos.toArray() for m in f.ptcld_markers]);
-          #for now ignore all non perfect data
-          if data.shape[0] == M:
-            d[j,:,:] = np.asarray([m.pos.toArray() for m in f.ptcld_markers])
-
-      return t,d
+          error[j] = f.mean_error
+          for k, m in enumerate(f.markers[0:M]):
+            # parse as in FrameArrays.append_extended, so missing values are NaN and untracked
+            values = to_floats([m.tracked, m.quality])
+            tracked[j,m.id] = np.nan_to_num(values[0]) > 0
+            quality[j,m.id] = values[1]
+      return t, tracked, quality, error
 
     #---------------------------------------------------------------
-    def data(self):
+    def data(self, layout='padded'):
       """
       t,d,D,S = data()
 
@@ -142,29 +204,37 @@ class Run():
       d - N x M x 3 - x,y,z data for M markers in N frames
       D - N x M_l x 3 - x,y,z data for M_l markers in N frames from trackable l
       S - N x L x 6 - yaw,pitch,roll,x,y,z data for L trackables in N frames
+
+      The layout argument selects the form of the marker data d:
+      'padded' - N x M x 3 array, padded with NaN to the maximum marker count M (default)
+      'ragged' - (positions, offsets) pair of a K x 3 array of all K markers and
+                 N+1 offsets; the markers of frame i are positions[offsets[i]:offsets[i+1]]
+      'views'  - MarkerViews sequence of K_i x 3 array views, one per frame
+
+      The 'ragged' and 'views' forms share the storage of a columnar run,
+      which is read-only when it was loaded from the binary cache; the
+      other results are new arrays.
       """
+      if self.arrays is not None:
+        a = self.arrays
+        S = np.concatenate((a.states[:,:,7:10], a.states[:,:,0:3]), axis=2)
+        return np.array(a.timestamps), marker_layout(a.marker_positions, a.marker_offsets, layout), [], S
+
       if not self.frames:
         return None,None,None,None
-      #t,d = zip(*[(f.timestamp,[m.pos.toArray() for m in f.markers]) 
-      #                                         for f in self.frames])
-      #t = [f.timestamp for f in self.frames]
-      #d = [[m.pos.toArray() for m in f.markers] for f in self.frames]
-      t = []; d = []; D = [];
+
+      # collect the markers of all frames into a single ragged array
+      t = np.array([f.timestamp for f in self.frames])
+      offsets = np.cumsum([0] + [len(f.markers) for f in self.frames])
+      positions = np.array([m.pos.toArray() for f in self.frames for m in f.markers]).reshape((-1, 3))
+      D = []
+
       S = np.nan*np.zeros((len(self.frames),self.trackablecount,6))
       for j,f in enumerate(self.frames):
-          t.append(f.timestamp)
-          d.append([m.pos.toArray() for m in f.markers])
           for s in f.trackable_states:
               S[j,s.id-1,:] = np.hstack((s.erot.toArray(),s.pos.toArray()))
 
-
-      m = [len(dd) for dd in d]
-      M = max(m)
-      p = [np.nan*np.ones(3) for m in range(M)]
-
-      d = [dd + p[len(dd):] for dd in d]
-
-      return np.array(t),np.array(d),D,np.array(S)
+      return t,marker_layout(positions, offsets, layout),D,S
 
     #---------------------------------------------------------------
     def trajectory(self, name, warnings=5 ):
@@ -176,43 +246,59 @@ class Run():
         q - N x 4 - qx, qy, qz, qw quaternion orientation for N frames.
         ypr - N x 3 - yaw, pitch, roll, Euler angle sets for N frames.
         """
-      
-        # determine the index of the body within the list of rigid bodies
-        names = [t.name for t in self.trackables]
-        body_idx = names.index(name)
-        
-        # determine the body ID number reported with each frame
-        body_id  = self.trackables[body_idx].id
-
-        t = []
-        x = []
-        q = []
-        ypr = []
-
-        warning_count = 0
-
-        for i,f in enumerate(self.frames):
-            # check whether the body appears in this frame
-            try:
-                idx = [state.id for state in f.trackable_states].index(body_id)
-                t.append(f.timestamp)
-                state = f.trackable_states[idx]
-                x.append( state.pos.toArray() )
-                q.append( state.qrot.toArray( ) )
-                ypr.append( state.erot.toArray() )
-
-            except ValueError:
-                warning_count += 1
-                if warnings and warning_count <= warnings:
-                    print "Body '%s' does not appear in frame %d." % (name, i)                    
-                    if warning_count == warnings: print "(Additional warnings for '%s' will be suppressed.)" % name
+        return self.trajectories([name], warnings)[0]
 
-                pass
+    #---------------------------------------------------------------
+    def trajectories(self, names, warnings=5 ):
+        """Return the trajectories of several rigid bodies in one pass.
 
-        return np.array(t), np.array(x), np.array(q), np.array(ypr)
+        Returns a list with a (t, x, q, ypr) tuple for each name in the same form
+        as trajectory().  The samples are gathered using the per-body frame
+        index built while loading, so no per-frame search is required.
+        """
+        body_names = [t.name for t in self.trackables]
+        result = []
+        for name in names:
+            # determine the index of the body within the list of rigid bodies
+            body_idx = body_names.index(name)
+
+            # determine the body ID number reported with each frame
+            body_id  = self.trackables[body_idx].id
+
+            if self.arrays is not None:
+                # in columnar mode the body is a column of the state array;
+                # like a frame list, a body excluded from the load has no samples
+                a = self.arrays
+                col = a.column(body_id) if body_id in a.body_ids else None
+                rows = a.body_rows[col] if col is not None else np.zeros(0, dtype=int)
+                frame_count = a.count
+            else:
+                rows, positions = self.body_index.get(body_id, (np.zeros(0, dtype=int), np.zeros(0, dtype=int)))
+                frame_count = len(self.frames)
+
+            if warnings and len(rows) < frame_count:
+                present = np.zeros(frame_count, dtype=bool)
+                present[rows] = True
+                missing = np.flatnonzero(~present)
+                for i in missing[0:warnings]:
+                    print "Body '%s' does not appear in frame %d." % (name, i)
+                if len(missing) >= warnings: print "(Additional warnings for '%s' will be suppressed.)" % name
+
+            if self.arrays is not None:
+                # gathering from memory-mapped cache arrays gives read-only
+                # results, so these are copied to be writable as from a fresh parse
+                states = np.array(a.states[rows, col]) if col is not None else np.zeros((0, SVL))
+                result.append((np.array(a.timestamps[rows]), states[:,0:3], states[:,3:7], states[:,7:10]))
+            else:
+                states = [self.frames[i].trackable_states[k] for i, k in zip(rows, positions)]
+                result.append((np.array([self.frames[i].timestamp for i in rows]),
+                               np.array([state.pos.toArray() for state in states]),
+                               np.array([state.qrot.toArray() for state in states]),
+                               np.array([state.erot.toArray() for state in states])))
+        return result
 
     #---------------------------------------------------------------
-    def ReadFile(self, data_dir, filename, N=np.inf, verbose=False):
+    def ReadFile(self, data_dir, filename, N=np.inf, verbose=False, columnar=False, bodies=None, markers=True, cache=True, processes=1, extended=False):
         """Load a CSV motion capture data file.
 
         Args:
@@ -222,77 +308,818 @@ class Run():
         Keyword arguments:
         N -- maximum number of frames to process (default unlimited).
         verbose -- flag to enable debugging console output (default False). 
+        columnar -- flag to parse the frames into self.arrays instead of Frame objects (default False).
+        bodies -- list of rigid body names to parse, the fields for other bodies are skipped (default all).
+        markers -- flag to parse the unlabeled markers (default True).
+        cache -- flag to use a binary cache beside the file for a complete columnar load (default True).
+        processes -- number of worker processes for a complete columnar load of an uncompressed file (default 1).
+        extended -- flag to parse the extended rigid body records following each frame (default False).
         """
 
         self.dir = data_dir
         self.fi  = filename
         filename = os.path.join(data_dir, filename)
-        fp = csv.reader(open(filename, "rU"))
+
+        # A complete columnar load is saved to or mapped from a binary cache.
+        # The cache holds only the bodies, markers, and extended records which
+        # were requested.  A load needing more than the cache holds parses the
+        # file again for both, so the cache grows to cover every use of the
+        # file; any selection is applied afterward.
+        cached = columnar and cache and N == np.inf
+        parse_bodies, parse_markers, parse_extended = bodies, markers, extended
+        if cached:
+            if self.ReadCache(filename, verbose, bodies, markers, extended):
+                self.arrays = self.arrays.select(self.select_trackables(bodies), markers)
+                self.frames = FrameList(self.arrays)
+                return self
+            header = read_cache_header(filename)
+            if header is not None:
+                if bodies is not None:
+                    parse_bodies = None if header['bodies'] is None else header['bodies'] + [name for name in bodies if name not in header['bodies']]
+                parse_markers = markers or header['markers']
+                parse_extended = extended or header['extended']
+
+        # a compressed file cannot be divided into byte ranges, so it is always parsed serially
+        if columnar and processes > 1 and N == np.inf and datafiles.compression_type(filename) is None:
+            self.ReadParallel(filename, processes, parse_bodies, parse_markers, verbose, parse_extended)
+
+        else:
+            fp = csv.reader(datafiles.open_data_file(filename, "rU"))
+            frames = 0
+            ids = None
+            index = {}
+            for fields in self.ReadRows(fp, verbose):
+                if frames >= N:
+                    break
+
+                if fields[0].lower() == "frame":
+                    if columnar:
+                        if self.arrays is None:
+                            self.arrays = FrameArrays(self.select_trackables(parse_bodies), min(N, self.framecount), parse_markers, parse_extended)
+                        self.arrays.append(fields)
+                    else:
+                        if ids is None and bodies is not None:
+                            ids = set(str(t.id) for t in self.select_trackables(bodies))
+                        frame = Frame(fields, ids, markers)
+                        for k, state in enumerate(frame.trackable_states):
+                            if state.id not in index:
+                                index[state.id] = (array.array('l'), array.array('l'))
+                            index[state.id][0].append(len(self.frames))
+                            index[state.id][1].append(k)
+                        self.frames.append(frame)
+                    frames += 1
+
+                elif fields[0].lower() == "rigidbody" and parse_extended:
+                    if columnar:
+                        if self.arrays is not None:
+                            self.arrays.append_extended(fields)
+                    elif bodies is None or fields[3] in bodies:
+                        self.trackable_frames.append(TrackableFrame(fields))
+
+            # convert the per-body frame index to arrays
+            for id, (rows, positions) in index.items():
+                self.body_index[id] = (np.array(rows, dtype=int), np.array(positions, dtype=int))
+
+        if columnar:
+            if self.arrays is None:
+                self.arrays = FrameArrays(self.select_trackables(parse_bodies), 0, parse_markers, parse_extended)
+            self.arrays.trim()
+
+            if cached:
+                self.WriteCache(filename, verbose)
+                self.arrays = self.arrays.select(self.select_trackables(bodies), markers)
+
+            # serve the legacy frame list interface from the arrays
+            self.frames = FrameList(self.arrays)
+        return self
+
+    #---------------------------------------------------------------
+    def ReadParallel(self, filename, processes, bodies=None, markers=True, verbose=False, extended=False):
+        """Load the frames of a CSV file into self.arrays using a pool of worker processes.
+
+        The header is processed first, then the remaining file is divided into
+        byte ranges starting on frame rows.  Each range is parsed into a
+        FrameArrays block by a worker process and the blocks are concatenated in
+        frame order.
+
+        Args:
+            filename: path of the CSV file
+            processes: number of worker processes
+        """
+        start = self.ReadHeader(filename, verbose)
+        end = os.path.getsize(filename)
+
+        # Use several ranges per process to balance the load.
+        fp = open(filename, 'rb')
+        count = 4 * processes
+        bounds = [start] + [frame_boundary(fp, start + (i * (end - start)) // count) for i in range(1, count)] + [end]
+        fp.close()
+
+        trackables = self.select_trackables(bodies)
+        jobs = [(filename, bounds[i], bounds[i+1], trackables, markers, extended) for i in range(count) if bounds[i] < bounds[i+1]]
+        if verbose: print "Parsing %d byte ranges with %d processes." % (len(jobs), processes)
+
+        pool = multiprocessing.Pool(processes)
         try:
-          while True:
-              if len( self.frames ) >= N:
-                  break
-              fields = fp.next()
-              if verbose: print "CSV input: ", fields
-
-              # the first field of every CSV line indentifies the row type
-              row_type = fields[0].lower()
-
-              if row_type == "comment":
-                  pass
-
-              elif row_type == "righthanded":
-                  self.coord_type = 'right'
-
-              elif row_type == "lefthanded":
-                  self.coord_type = 'left'
-
-              elif row_type == "info":
-                  if fields[1].lower() == "framecount":
-                      self.framecount = int(fields[2])
-
-                  elif verbose and fields[1].lower() == "version":
-                      print "File format version", fields[2]
-
-                      # For now, just fail if the Optitrack file format version
-                      # is different.  If the Optitrack software is updated,
-                      # this might need to change.  Note that the format is
-                      # already different than the original Olin code, but it
-                      # isn't clear what Optitrack file version was used to
-                      # create that code.
-                      assert fields[2] == '1.1', "Optitrack file format %s not tested." % fields[2]
-
-
-                  # N.B. the 'rigidbody' token can identify one of two possible
-                  # record types, either a body definition immediately following
-                  # the info section, or an extended information record
-                  # following a frame.  The following block processes the set of
-                  # body definitions; it makes the assumption that
-                  # rigidbodycount is always the last info field.
-                  elif fields[1].lower() == "rigidbodycount":
-                      self.trackablecount = int(fields[2])
-                      if self.trackablecount > 0:
-                          for i in range(self.trackablecount):
-                              self.trackables.append(Trackable(fp.next()))
-
-              elif row_type == "frame":
-                  self.frames.append(Frame(fields))
-
-              # FIXME: the following would process the extended frame information, but it is currently broken
-              # elif row_type == "rigidbody":
-              #   self.trackable_frames.append(TrackableFrame(fields))
-
-        except StopIteration:
-            return self
+            blocks = pool.map(parse_frame_range, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.arrays = concatenate_frames(trackables, blocks, markers, extended)
+        return self
+
+    #---------------------------------------------------------------
+    def ReadHeader(self, filename, verbose=False):
+        """Process the header rows of a CSV file into the object attributes.
+
+        Returns the byte offset of the first frame row, counted in the
+        decompressed stream for a compressed file.
+
+        Args:
+            filename: path of the CSV file
+        """
+        fp = datafiles.open_data_file(filename)
+        lines = []
+        while True:
+            offset = fp.tell()
+            line = fp.readline()
+            if not line or is_frame_row(line):
+                break
+            lines.append(line)
+        fp.close()
+
+        for fields in self.ReadRows(csv.reader(lines), verbose):
+            pass
+        return offset
+
+    #---------------------------------------------------------------
+    def ReadCache(self, filename, verbose=False, bodies=None, markers=True, extended=False):
+        """Load the header and columnar frame data from the binary cache for a CSV file.
+
+        The arrays are memory-mapped read-only.  Returns True on success, or
+        False if the cache is missing, unreadable, out of date with respect
+        to the CSV file, or does not hold all the requested data, in which
+        case the object is left unmodified.
+
+        Args:
+            filename: path of the CSV file
+
+        Keyword arguments:
+        bodies, markers, extended -- the data required, as for ReadFile
+        """
+        path = cache_path(filename)
+        header = read_cache_header(filename)
+        if header is None:
+            if verbose and os.path.isdir(path): print "Ignoring out-of-date cache", path
+            return False
+        if ((header['bodies'] is not None and (bodies is None or not set(bodies).issubset(header['bodies'])))
+            or (markers and not header['markers']) or (extended and not header['extended'])):
+            if verbose: print "Cache %s does not hold the requested data" % path
+            return False
+
+        try:
+            # JSON returns unicode strings, which are converted to the str of a fresh parse
+            trackables = [Trackable([field.encode('utf-8') for field in fields]) for fields in header['trackables']]
+            stored = trackables
+            if header['bodies'] is not None:
+                names = [t.name for t in trackables]
+                stored = [trackables[names.index(name.encode('utf-8'))] for name in header['bodies']]
+            arrays = FrameArrays(stored, 0, header['markers'], header['extended'])
+            for name in FrameArrays.array_names:
+                setattr(arrays, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+            arrays.marker_names = [name.encode('utf-8') for name in header['marker_names']]
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+
+        if verbose: print "Loaded cache", path
+        self.coord_type = str(header['coord_type'])
+        self.framecount = header['framecount']
+        self.trackablecount = header['trackablecount']
+        self.trackables = trackables
+        arrays.count = len(arrays.timestamps)
+        arrays.index_bodies()
+        self.arrays = arrays
+        return True
+
+    #---------------------------------------------------------------
+    def WriteCache(self, filename, verbose=False):
+        """Save the header and columnar frame data into the binary cache for a CSV file.
+
+        The cache is a directory beside the CSV file holding one .npy file per
+        array and a JSON header identifying the CSV file by size, modification
+        time and a hash of its contents.  Failures to write the cache are not
+        fatal.  Returns True on success.
+
+        Args:
+            filename: path of the CSV file
+        """
+        path = cache_path(filename)
+
+        # the body names are recorded unless every body is present
+        bodies = None
+        if self.arrays.body_ids != [t.id for t in self.trackables]:
+            bodies = [t.name for id in self.arrays.body_ids for t in self.trackables if t.id == id]
+
+        header = { 'key'            : cache_key(filename),
+                   'coord_type'     : self.coord_type,
+                   'framecount'     : self.framecount,
+                   'trackablecount' : self.trackablecount,
+                   'trackables'     : [t.toFields() for t in self.trackables],
+                   'bodies'         : bodies,
+                   'markers'        : self.arrays.markers,
+                   'extended'       : self.arrays.extended,
+                   'marker_names'   : self.arrays.marker_names }
+        # The cache is written into a temporary directory which then replaces
+        # any existing cache, so a concurrent reader never sees a partial
+        # cache, and a reader which has already mapped the old arrays keeps
+        # them.  The header is written last so an interrupted write is never valid.
+        temporary = "%s.%d.partial" % (path, os.getpid())
+        try:
+            if os.path.isdir(temporary):
+                shutil.rmtree(temporary)
+            os.mkdir(temporary)
+            for name in FrameArrays.array_names:
+                np.save(os.path.join(temporary, name + '.npy'), getattr(self.arrays, name))
+            open(os.path.join(temporary, 'header.json'), 'w').write(json.dumps(header))
+            clear_cache(filename)
+            os.rename(temporary, path)
+        except (IOError, OSError), e:
+            if verbose: print "Unable to write cache %s: %s" % (path, e)
+            if os.path.isdir(temporary):
+                shutil.rmtree(temporary, ignore_errors=True)
+            return False
+
+        if verbose: print "Wrote cache", path
+        return True
+
+    #---------------------------------------------------------------
+    def ReadRows(self, fp, verbose=False):
+        """Generate the data rows from a CSV reader, processing the header rows along the way.
+
+        The comment, coordinate convention, info, and rigid body definition rows
+        are processed into the object attributes.  Each remaining frame row or
+        extended rigid body record is yielded as a list of fields.
+
+        Args:
+            fp: csv.reader object for the file
+        """
+        for fields in fp:
+            if verbose: print "CSV input: ", fields
+            if not fields:
+                continue
+
+            # the first field of every CSV line indentifies the row type
+            row_type = fields[0].lower()
+
+            if row_type == "comment":
+                pass
+
+            elif row_type == "righthanded":
+                self.coord_type = 'right'
+
+            elif row_type == "lefthanded":
+                self.coord_type = 'left'
+
+            elif row_type == "info":
+                if fields[1].lower() == "framecount":
+                    self.framecount = int(fields[2])
+
+                elif verbose and fields[1].lower() == "version":
+                    print "File format version", fields[2]
+
+                    # For now, just fail if the Optitrack file format version
+                    # is different.  If the Optitrack software is updated,
+                    # this might need to change.  Note that the format is
+                    # already different than the original Olin code, but it
+                    # isn't clear what Optitrack file version was used to
+                    # create that code.
+                    assert fields[2] == '1.1', "Optitrack file format %s not tested." % fields[2]
+
+
+                # N.B. the 'rigidbody' token can identify one of two possible
+                # record types, either a body definition immediately following
+                # the info section, or an extended information record
+                # following a frame.  The following block processes the set of
+                # body definitions; it makes the assumption that
+                # rigidbodycount is always the last info field.
+                elif fields[1].lower() == "rigidbodycount":
+                    self.trackablecount = int(fields[2])
+                    if self.trackablecount > 0:
+                        for i in range(self.trackablecount):
+                            self.trackables.append(Trackable(fp.next()))
+
+            else:
+                yield fields
+
+    #---------------------------------------------------------------
+    def iter_frames(self, data_dir, filename, bodies=None, chunk=1200, verbose=False, markers=True, extended=False):
+        """Generate the frames of a CSV motion capture data file as a sequence of fixed-size FrameArrays blocks.
+
+        This reads the file incrementally, so memory use is bounded by the chunk
+        size regardless of the length of the capture.  The header information
+        is processed into the object attributes before the first block is
+        yielded; self.frames and self.arrays are left untouched.
+
+        Args:
+            data_dir: string directory name
+            filename: string name of the file to load
+
+        Keyword arguments:
+        bodies -- list of rigid body names to include in the state arrays (default all).
+        chunk -- number of frames in each block, the final block may be shorter (default 1200).
+        verbose -- flag to enable debugging console output (default False). 
+        markers -- flag to parse the unlabeled markers (default True).
+        extended -- flag to parse the extended rigid body records following each frame (default False).
+        """
+
+        self.dir = data_dir
+        self.fi  = filename
+        filename = os.path.join(data_dir, filename)
+        fp = csv.reader(datafiles.open_data_file(filename, "rU"))
+        block = None
+        for fields in self.ReadRows(fp, verbose):
+            if fields[0].lower() == "frame":
+                # a full block is only complete once the next frame begins, as
+                # extended records follow their frame
+                if block is not None and block.count == chunk:
+                    yield block.trim()
+                    block = None
+                if block is None:
+                    block = FrameArrays(self.select_trackables(bodies), chunk, markers, extended)
+                block.append(fields)
+
+            elif fields[0].lower() == "rigidbody" and block is not None:
+                block.append_extended(fields)
+
+        if block is not None:
+            yield block.trim()
+
+    #---------------------------------------------------------------
+    def read_window(self, data_dir, filename, t0, t1, bodies=None, markers=True, extended=False, stride=INDEX_STRIDE, verbose=False):
+        """Load only the frames of a CSV file with timestamps between t0 and t1 (inclusive) into self.arrays.
+
+        A sparse index of the byte offsets of every stride'th frame is read from
+        a file beside the CSV file, or created by a single scan of the file if
+        missing or out of date.  The parse then seeks directly to the indexed
+        frame preceding t0.  This assumes the timestamps are increasing.
+
+        A compressed file also works, but seeking within it requires
+        decompressing the stream up to the offset.
+
+        Args:
+            data_dir: string directory name
+            filename: string name of the file to load
+            t0, t1: time range in seconds
+
+        Keyword arguments:
+        bodies -- list of rigid body names to parse (default all).
+        markers -- flag to parse the unlabeled markers (default True).
+        extended -- flag to parse the extended rigid body records following each frame (default False).
+        stride -- number of frames between index entries if a new index is created (default INDEX_STRIDE).
+        verbose -- flag to enable debugging console output (default False). 
+        """
+        self.dir = data_dir
+        self.fi  = filename
+        filename = os.path.join(data_dir, filename)
+
+        start = self.ReadHeader(filename, verbose)
+        offsets, timestamps = read_frame_index(filename, stride, verbose)
+        k = np.searchsorted(timestamps, t0, side='right') - 1
+        if k >= 0:
+            start = offsets[k]
+        if verbose: print "Seeking to byte offset %d for time %f." % (start, t0)
+
+        fp = datafiles.open_data_file(filename)
+        fp.seek(start)
+        arrays = FrameArrays(self.select_trackables(bodies), 1024, markers, extended)
+        inside = False
+        for fields in csv.reader(read_lines(fp)):
+            if not fields:
+                continue
+            if fields[0].lower() == "frame":
+                t = float(fields[2])
+                if t > t1:
+                    break
+                inside = t >= t0
+                if inside:
+                    arrays.append(fields)
+            elif fields[0].lower() == "rigidbody" and inside:
+                arrays.append_extended(fields)
+        fp.close()
+
+        self.arrays = arrays.trim()
+        self.frames = FrameList(self.arrays)
+        return self
+
+    #---------------------------------------------------------------
+    def select_trackables(self, bodies=None):
+        """Return the list of Trackable objects for a list of body names, or all of them for None."""
+        if bodies is None:
+            return self.trackables
+        names = [t.name for t in self.trackables]
+        return [self.trackables[names.index(name)] for name in bodies]
 
     def __repr__( self ):
       return "run = {'dir':%s,'fi':%s}" % (self.dir,self.fi)
 
+################################################################
+class IncrementalRun(Run):
+    """Represents a motion capture run read incrementally from a CSV file which is still being written.
+
+    Each call to poll() parses only the complete rows appended since the
+    previous call, starting from the saved file offset.  The most recent
+    frames are kept in a FrameRing covering a bounded time span; older frames
+    are discarded, so memory use stays constant over a long session.
+
+    Object attributes (in addition to those of Run):
+    path      full path to the CSV file
+    offset    byte offset of the first unparsed row
+    ring      FrameRing holding the recent frames, or None until the header has been read
+    """
+
+    def __init__(self, data_dir, filename, seconds=10.0, rate=120.0, bodies=None, markers=False):
+        """Constructor for an incremental reader; no data is read until poll() is called.
+
+        Args:
+            data_dir: string directory name
+            filename: string name of the file to follow
+
+        Keyword arguments:
+        seconds -- time span of recent frames to keep (default 10.0).
+        rate -- maximum expected frame rate in Hz, used to size the ring buffer (default 120.0).
+        bodies -- list of rigid body names to keep (default all).
+        markers -- flag to parse the unlabeled markers (default False).
+        """
+        Run.__init__(self)
+        self.dir = data_dir
+        self.fi  = filename
+        self.path = os.path.join(data_dir, filename)
+        self.seconds = seconds
+        self.rate = rate
+        self.capacity = int(np.ceil(seconds * rate)) + 1
+        self.bodies = bodies
+        self.markers = markers
+        self.offset = 0
+        self.ring = None
+        self.header_lines = []
+
+    def poll(self):
+        """Parse any complete rows appended to the file since the last call.
+
+        Returns the number of new frames.  If the file has been truncated or
+        replaced by a shorter one, reading starts over from the beginning.
+        """
+        if not os.path.exists(self.path):
+            return 0
+        size = os.path.getsize(self.path)
+        if size < self.offset:
+            self.__init__(self.dir, self.fi, self.seconds, self.rate, self.bodies, self.markers)
+        if size == self.offset:
+            return 0
+
+        fp = open(self.path, 'rb')
+        fp.seek(self.offset)
+        text = fp.read(size - self.offset)
+        fp.close()
+
+        # only process complete lines; a partial last line is read again next time
+        end = text.rfind('\n') + 1
+        if end == 0:
+            return 0
+        self.offset += end
+        lines = text[0:end].splitlines(True)
+
+        # collect the header lines until the first frame row appears
+        if self.ring is None:
+            for i, line in enumerate(lines):
+                if is_frame_row(line):
+                    for fields in self.ReadRows(csv.reader(self.header_lines)):
+                        pass
+                    self.header_lines = None
+                    self.ring = FrameRing(self.select_trackables(self.bodies), self.capacity)
+                    lines = lines[i:]
+                    break
+                self.header_lines.append(line)
+            else:
+                return 0
+
+        block = FrameArrays(self.select_trackables(self.bodies), len(lines), self.markers)
+        for fields in csv.reader(lines):
+            if fields and fields[0].lower() == "frame":
+                block.append(fields)
+        self.ring.extend(block.trim())
+        return block.count
+
+    def follow(self, interval=0.01):
+        """Generate the number of new frames each time poll() finds new data, checking every interval seconds.
+
+        This runs indefinitely; the caller should stop iterating when done.
+        """
+        while True:
+            count = self.poll()
+            if count > 0:
+                yield count
+            else:
+                time.sleep(interval)
+
+    def trajectories(self, names, warnings=0 ):
+        """Return the recent trajectories of several rigid bodies from the ring buffer.
+
+        Returns a list with a (t, x, q, ypr) tuple for each name in the same
+        form as Run.trajectory(), covering the last 'seconds' of data.
+        """
+        if self.ring is None:
+            return [(np.zeros(0), np.zeros((0,3)), np.zeros((0,4)), np.zeros((0,3))) for name in names]
+        return [self.ring.trajectory(self.select_trackables([name])[0].id, self.seconds) for name in names]
+
+################################################################
+class FrameRing():
+    """A fixed-capacity ring buffer of the most recent rigid body states.
+
+    Object attributes:
+    body_ids     list of rigid body ID numbers, one per state column
+    capacity     maximum number of frames held
+    count        total number of frames added so far
+    timestamps   capacity element array of timestamps
+    states       capacity x B x 10 array of states in the FrameArrays layout
+    """
+
+    def __init__(self, trackables, capacity):
+        self.body_ids = [t.id for t in trackables]
+        self.capacity = capacity
+        self.count = 0
+        self.timestamps = np.nan * np.zeros(capacity)
+        self.states = np.nan * np.zeros((capacity, len(self.body_ids), SVL))
+
+    def extend(self, arrays):
+        """Append the frames of a FrameArrays block with the same state columns, overwriting the oldest frames."""
+        n = min(arrays.count, self.capacity)
+        rows = (self.count + arrays.count - n + np.arange(n)) % self.capacity
+        self.timestamps[rows] = arrays.timestamps[arrays.count-n:]
+        self.states[rows] = arrays.states[arrays.count-n:]
+        self.count += arrays.count
+
+    def recent(self):
+        """Return the row numbers of the frames held, oldest first."""
+        n = min(self.count, self.capacity)
+        return (self.count - n + np.arange(n)) % self.capacity
+
+    def trajectory(self, id, seconds=np.inf):
+        """Return the (t, x, q, ypr) trajectory of a body ID over the most recent time span, oldest first."""
+        rows = self.recent()
+        if len(rows):
+            rows = rows[self.timestamps[rows] >= self.timestamps[rows[-1]] - seconds]
+        states = self.states[rows, self.body_ids.index(id)]
+        present = ~np.isnan(states[:,0])
+        states = states[present]
+        return self.timestamps[rows][present], states[:,0:3], states[:,3:7], states[:,7:10]
+
+################################################################
+def is_frame_row(line):
+    """Return True if a raw line of CSV text is a frame row."""
+    return line[0:6].lower() == 'frame,'
+
+def frame_boundary(fp, offset):
+    """Return the byte offset of the first frame row starting at or after a given offset.
+
+    fp     -- file object open in binary mode
+    offset -- byte offset within the file
+    """
+    # back up one byte so that a frame row starting exactly at offset is found
+    fp.seek(max(offset - 1, 0))
+    if offset > 0:
+        fp.readline()
+    while True:
+        position = fp.tell()
+        line = fp.readline()
+        if not line or is_frame_row(line):
+            return position
+
+def read_lines(fp, end=None):
+    """Generate the raw lines from the current position of a binary file object up to a byte offset or the end."""
+    while end is None or fp.tell() < end:
+        line = fp.readline()
+        if not line:
+            break
+        yield line
+
+def parse_frame_range(job):
+    """Parse the frame rows within a byte range of a CSV file into a FrameArrays block.
+
+    This is the worker function for Run.ReadParallel, so it takes a single
+    (filename, start, end, trackables, markers, extended) tuple.
+    """
+    filename, start, end, trackables, markers, extended = job
+    fp = open(filename, 'rb')
+    fp.seek(start)
+    arrays = FrameArrays(trackables, 1024, markers, extended)
+    for fields in csv.reader(read_lines(fp, end)):
+        if fields and fields[0].lower() == "frame":
+            arrays.append(fields)
+        elif fields and fields[0].lower() == "rigidbody":
+            arrays.append_extended(fields)
+    fp.close()
+    return arrays.trim()
+
+def concatenate_frames(trackables, blocks, markers=True, extended=False):
+    """Join a sequence of trimmed FrameArrays blocks into a single FrameArrays object in the same order."""
+    result = FrameArrays(trackables, 0, markers, extended).trim()
+    blocks = [result] + list(blocks)
+    base = np.cumsum([0] + [len(b.marker_ids) for b in blocks[0:-1]])
+
+    for name in FrameArrays.row_names:
+        setattr(result, name, np.concatenate([getattr(b, name) for b in blocks]))
+    result.marker_offsets = np.concatenate([[0]] + [b.marker_offsets[1:] + n for b, n in zip(blocks, base)])
+    result.marker_positions = np.concatenate([b.marker_positions for b in blocks])
+    result.marker_ids = np.concatenate([b.marker_ids for b in blocks])
+
+    # merge the marker name tables, renumbering the name index of each block
+    codes = [np.array([result.marker_code(name) for name in b.marker_names], dtype=int) for b in blocks]
+    result.marker_name_index = np.concatenate([c[b.marker_name_index] for b, c in zip(blocks, codes)])
+    result.count = len(result.timestamps)
+    result.index_bodies()
+    return result
+
+def to_floats(values):
+    """Convert a list of CSV fields to an array of floats, with NaN for missing values."""
+    return np.array([float(v) if v and not( bad in v ) else np.nan for v in values])
+
+################################################################
+def frame_index_path(filename):
+    """Return the path of the frame offset index file for a CSV file."""
+    return filename + INDEX_SUFFIX
+
+def build_frame_index(filename, stride=INDEX_STRIDE):
+    """Scan a CSV file for the byte offsets and timestamps of every stride'th frame row.
+
+    The file is read in large blocks and only the indexed rows are parsed, so
+    the scan runs much faster than a full parse.  Returns an (offsets,
+    timestamps) pair of arrays.
+    """
+    start = Run().ReadHeader(filename)
+    fp = datafiles.open_data_file(filename)
+    fp.seek(start)
+
+    offsets = array.array('l')
+    timestamps = array.array('d')
+    count = 0
+    position = start    # file offset of the start of text
+    text = ''           # unscanned text, always beginning at the start of a line
+    while True:
+        block = fp.read(INDEX_BLOCK_BYTES)
+        text += block
+        # only scan complete lines unless the file has ended
+        end = len(text) if not block else text.rfind('\n') + 1
+
+        i = 0 if text.startswith('frame,') else next_frame_row(text, 0, end)
+        while 0 <= i < end:
+            if count % stride == 0:
+                line_end = text.find('\n', i)
+                line = text[i:line_end] if line_end >= 0 else text[i:]
+                offsets.append(position + i)
+                timestamps.append(float(line.split(',', 3)[2]))
+            count += 1
+            i = next_frame_row(text, i, end)
+
+        if not block:
+            break
+        position += end
+        text = text[end:]
+
+    fp.close()
+    return np.array(offsets, dtype=int), np.array(timestamps)
+
+def next_frame_row(text, start, end):
+    """Return the position of the next frame row following position start in a block of CSV text, or -1."""
+    i = text.find('\nframe,', start, end)
+    return i + 1 if i >= 0 else -1
+
+def read_frame_index(filename, stride=INDEX_STRIDE, verbose=False):
+    """Return the (offsets, timestamps) frame offset index for a CSV file.
+
+    The index is loaded from the index file beside the CSV file if it matches
+    the current file contents, else rebuilt with build_frame_index and saved
+    if possible.
+    """
+    path = frame_index_path(filename)
+    key = cache_key(filename)
+    try:
+        index = np.load(path)
+        if json.loads(str(index['key'])) == key:
+            return index['offsets'], index['timestamps']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    if verbose: print "Indexing", filename
+    offsets, timestamps = build_frame_index(filename, stride)
+    try:
+        np.savez(open(path, 'wb'), key=json.dumps(key), offsets=offsets, timestamps=timestamps)
+    except (IOError, OSError), e:
+        if verbose: print "Unable to write frame index %s: %s" % (path, e)
+    return offsets, timestamps
+
+################################################################
+def marker_layout(positions, offsets, layout='padded'):
+    """Arrange ragged marker data in one of the forms returned by Run.data.
+
+    positions -- K x 3 array of marker positions for all frames
+    offsets   -- N+1 element array; the markers of frame i are positions[offsets[i]:offsets[i+1]]
+    layout    -- 'padded', 'ragged', or 'views'
+    """
+    if layout == 'ragged':
+        return positions, offsets
+    elif layout == 'views':
+        return MarkerViews(positions, offsets)
+    elif layout != 'padded':
+        raise ValueError("Unknown marker layout '%s'." % layout)
+
+    # scatter each marker into its frame row and its position within the frame
+    counts = np.diff(offsets)
+    M = counts.max() if len(counts) else 0
+    d = np.nan * np.zeros((len(counts), M, 3))
+    rows = np.repeat(np.arange(len(counts)), counts)
+    cols = np.arange(len(positions)) - np.repeat(offsets[0:-1], counts)
+    d[rows, cols] = positions
+    return d
+
+class MarkerViews(object):
+    """A read-only sequence of per-frame views into ragged marker data.
+
+    Each item is a K_i x 3 view of the positions of the markers in frame i; the
+    views are created on access.
+    """
+    __slots__ = ('positions', 'offsets')
+
+    def __init__(self, positions, offsets):
+        self.positions = positions
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("frame index out of range")
+        return self.positions[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+################################################################
+def cache_path(filename):
+    """Return the path of the binary cache directory for a CSV file."""
+    return filename + CACHE_SUFFIX
+
+def cache_key(filename):
+    """Return a dictionary identifying the current contents of a CSV file.
+
+    The key includes the file size, the modification time, and a SHA-1 hash of
+    the first and last blocks of the file, which is much faster than hashing a
+    multi-gigabyte capture while still detecting a replaced file.
+    """
+    info = os.stat(filename)
+    digest = hashlib.sha1()
+    fp = open(filename, 'rb')
+    digest.update(fp.read(CACHE_HASH_BYTES))
+    if info.st_size > CACHE_HASH_BYTES:
+        fp.seek(max(info.st_size - CACHE_HASH_BYTES, CACHE_HASH_BYTES))
+        digest.update(fp.read())
+    fp.close()
+    return { 'version' : CACHE_VERSION,
+             'size'    : info.st_size,
+             'mtime'   : info.st_mtime,
+             'sha1'    : digest.hexdigest() }
+
+def read_cache_header(filename):
+    """Return the header of the binary cache for a CSV file, or None if it is missing or out of date."""
+    try:
+        header = json.loads(open(os.path.join(cache_path(filename), 'header.json')).read())
+        if header['key'] == cache_key(filename):
+            return header
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return None
+
+def clear_cache(filename):
+    """Remove the binary cache for a CSV file, if present."""
+    path = cache_path(filename)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
 ################################################################
 class Frame():
     """Represents one frame of motion capture data"""
-    def __init__(self, fields):
-        """Constructor for a frame object"""
+    def __init__(self, fields, ids=None, markers=True):
+        """Constructor for a frame object
+
+        fields  -- list of frame fields from the CSV file
+        ids     -- set of rigid body ID strings to parse, others are skipped (default all)
+        markers -- flag to parse the unlabeled markers (default True)
+        """
         if fields[0].lower() != "frame":
             raise Exception("You attempted to make a frame from something " +\
                             "that is not frame data.")
@@ -310,7 +1137,7 @@ class Frame():
         idx = 4
         if self.trackable_count > 0:
             for i in range(self.trackable_count):
-                if not( bad in ''.join(fields[idx:idx+TSL]) ):
+                if (ids is None or fields[idx] in ids) and not( bad in ''.join(fields[idx:idx+TSL]) ):
                     self.trackable_states.append(TrackableState(fields[idx:idx+TSL]))
                 idx += TSL
 
@@ -318,6 +1145,8 @@ class Frame():
         # following the rigid body fields is the marker count:
         self.marker_count = int(fields[idx])
         idx += 1
+        if not markers:
+            return
 
         # following the marker count is a set of fields per marker:
         #   x,y,z,id,name
@@ -329,9 +1158,366 @@ class Frame():
     def __repr__( self ):
       return "frame = {'index':%s,'t':%f,'m':%d,'l':%d}" % (self.index,self.timestamp,len(self.markers),self.trackable_count)
 
+################################################################
+class FrameArrays():
+    """Represents a sequence of motion capture frames as struct-of-arrays storage.
+
+    This is the columnar counterpart to a list of Frame objects.  The rigid body
+    states are held in one preallocated array with a column per body, and the
+    unlabeled markers of all frames are concatenated into one flat array indexed
+    by per-frame offsets, in the style of a compressed sparse row matrix.
+
+    The optional extended rigid body records are held in further arrays with
+    the same rows and columns, padded to the largest body marker count Mb.
+    Without extended data these arrays have no rows.
+
+    Object attributes:
+    body_ids          list of rigid body ID numbers, one per state column
+    count             the number of frames stored
+    frame_indices     N element integer array of frame index numbers from the file
+    timestamps        N element array of timestamps (in seconds)
+    states            N x B x 10 array of x,y,z, qx,qy,qz,qw, yaw,pitch,roll for B bodies, NaN if missing
+    marker_offsets    N+1 element integer array; markers of frame i are rows offsets[i]:offsets[i+1]
+    marker_positions  K x 3 array of x,y,z marker positions for all K markers
+    marker_ids        K element integer array of marker ID numbers
+    marker_names      list of the distinct marker names, in order of first appearance
+    marker_name_index K element integer array of the index of each marker name in marker_names
+    body_rows         list with an integer array for each state column of the rows in which the body is present
+    trk_present       N x B boolean array, true where an extended record was read
+    trk_markers       N x B x Mb x 3 array of x,y,z rigid body marker positions, NaN if missing
+    trk_ptcld         N x B x Mb x 3 array of x,y,z point cloud marker positions, NaN if missing
+    trk_tracked       N x B x Mb boolean array of marker tracked flags
+    trk_quality       N x B x Mb array of marker quality values, NaN if missing
+    trk_error         N x B array of rigid body mean marker error, NaN if missing
+    """
+
+    # the names of the array attributes with one row per frame
+    row_names = ('frame_indices', 'timestamps', 'states',
+                 'trk_present', 'trk_markers', 'trk_ptcld', 'trk_tracked', 'trk_quality', 'trk_error')
+
+    # the names of all the array attributes, e.g. for saving to a file
+    array_names = row_names + ('marker_offsets', 'marker_positions', 'marker_ids', 'marker_name_index')
+
+    def __init__(self, trackables, capacity=1024, markers=True, extended=False):
+        """Constructor for an empty set of frame arrays.
+
+        trackables -- list of Trackable objects defining the state columns; the fields of other bodies are skipped
+        capacity   -- number of frames to preallocate; the storage grows as needed
+        markers    -- flag to parse the unlabeled markers, else every frame is stored with no markers
+        extended   -- flag to parse the extended rigid body records
+        """
+        self.body_ids = [t.id for t in trackables]
+        self.columns = dict((str(id), col) for col, id in enumerate(self.body_ids))
+        self.markers = markers
+        self.extended = extended
+        self.body_rows = [np.zeros(0, dtype=int) for id in self.body_ids]
+        self.count = 0
+
+        B = len(self.body_ids)
+        Mb = max([t.num_markers for t in trackables] + [0])
+        capacity = max(int(capacity), 1)
+        ext_capacity = capacity if extended else 0
+        self.frame_indices = np.zeros(capacity, dtype=int)
+        self.timestamps = np.zeros(capacity)
+        self.states = np.nan * np.zeros((capacity, B, SVL))
+        self.trk_present = np.zeros((ext_capacity, B), dtype=bool)
+        self.trk_markers = np.nan * np.zeros((ext_capacity, B, Mb, 3))
+        self.trk_ptcld = np.nan * np.zeros((ext_capacity, B, Mb, 3))
+        self.trk_tracked = np.zeros((ext_capacity, B, Mb), dtype=bool)
+        self.trk_quality = np.nan * np.zeros((ext_capacity, B, Mb))
+        self.trk_error = np.nan * np.zeros((ext_capacity, B))
+
+        # the markers are accumulated in compact typed buffers until trimmed
+        self.marker_offsets = array.array('l', [0])
+        self.marker_positions = array.array('d')
+        self.marker_ids = array.array('l')
+        self.marker_name_index = array.array('l')
+
+        # each distinct marker name is stored once
+        self.marker_names = []
+        self.marker_codes = {}
+
+    def __len__(self):
+        return self.count
+
+    def column(self, id):
+        """Return the state column index for a rigid body ID.
+
+        Raises ValueError if the body was not among those loaded.
+        """
+        if id not in self.body_ids:
+            raise ValueError("Rigid body ID %s is not among the loaded bodies %s." % (id, self.body_ids))
+        return self.body_ids.index(id)
+
+    def append(self, fields):
+        """Parse a list of frame fields from the CSV file into the next row of storage."""
+        if self.count == len(self.timestamps):
+            self.grow(2 * self.count)
+
+        i = self.count
+        self.frame_indices[i] = int(fields[1])
+        self.timestamps[i] = float(fields[2])
+        trackable_count = int(fields[3])
+
+        # the rigid body fields follow the same layout parsed by Frame;
+        # unrequested bodies are skipped without inspecting the values
+        idx = 4
+        for k in range(trackable_count):
+            col = self.columns.get(fields[idx])
+            if col is not None:
+                values = fields[idx+1:idx+TSL]
+                if not( bad in ''.join(values) ):
+                    self.states[i, col] = [float(v) for v in values]
+            idx += TSL
+
+        marker_count = int(fields[idx]) if self.markers else 0
+        idx += 1
+        for k in range(marker_count):
+            values = fields[idx:idx+MSL]
+            if not( bad in ''.join(values) ):
+                self.marker_positions.extend([float(v) for v in values[0:3]])
+                self.marker_ids.append(int(values[3]))
+                self.marker_name_index.append(self.marker_code(values[4]))
+            idx += MSL
+
+        self.marker_offsets.append(len(self.marker_ids))
+        self.count += 1
+
+    def marker_code(self, name):
+        """Return the index of a marker name in marker_names, adding it if new."""
+        code = self.marker_codes.get(name)
+        if code is None:
+            code = self.marker_codes[name] = len(self.marker_names)
+            self.marker_names.append(name)
+        return code
+
+    def append_extended(self, fields):
+        """Parse a list of extended rigid body record fields from the CSV file into the most recent row.
+
+        The record is ignored unless extended data was requested, the body is
+        one of the state columns, and the record follows its own frame.  See
+        TrackableFrame for the field layout.
+        """
+        i = self.count - 1
+        col = self.columns.get(fields[4])
+        if not self.extended or col is None or i < 0 or self.frame_indices[i] != int(fields[1]):
+            return
+
+        M = int(fields[6])
+        m = min(M, self.trk_tracked.shape[2])
+        idx = 7
+        self.trk_present[i, col] = True
+        self.trk_markers[i, col, 0:m] = to_floats(fields[idx:idx+3*m]).reshape((m, 3))
+        idx += 3*M
+        self.trk_ptcld[i, col, 0:m] = to_floats(fields[idx:idx+3*m]).reshape((m, 3))
+        idx += 3*M
+        self.trk_tracked[i, col, 0:m] = np.nan_to_num(to_floats(fields[idx:idx+m])) > 0
+        idx += M
+        self.trk_quality[i, col, 0:m] = to_floats(fields[idx:idx+m])
+        idx += M
+        self.trk_error[i, col] = to_floats(fields[idx:idx+1])[0]
+
+    def grow(self, capacity):
+        """Resize the preallocated frame storage to hold the given number of frames."""
+        capacity = max(capacity, self.count, 1)
+        for name in self.row_names:
+            old = getattr(self, name)
+            if len(old) == 0 and self.count > 0:
+                continue    # an unused extended data array
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            if old.dtype.kind == 'f':
+                new.fill(np.nan)
+            new[0:self.count] = old[0:self.count]
+            setattr(self, name, new)
+
+    def trim(self):
+        """Release unused preallocated storage and convert the marker buffers to numpy arrays."""
+        for name in self.row_names:
+            old = getattr(self, name)
+            if len(old) > self.count:
+                setattr(self, name, old[0:self.count].copy())
+        self.marker_offsets = np.asarray(self.marker_offsets, dtype=int)
+        self.marker_positions = np.asarray(self.marker_positions, dtype=float).reshape((-1, 3))
+        self.marker_ids = np.asarray(self.marker_ids, dtype=int)
+        self.marker_name_index = np.asarray(self.marker_name_index, dtype=int)
+        self.index_bodies()
+        return self
+
+    def index_bodies(self):
+        """Compute body_rows, the frame rows in which each body is present, from the NaN entries of the states."""
+        self.body_rows = [np.flatnonzero(~np.isnan(self.states[:, col, 0])) for col in range(len(self.body_ids))]
+
+    def select(self, trackables, markers=True):
+        """Return frame arrays restricted to a subset of the rigid bodies, optionally without markers.
+
+        The result shares storage with this object where possible.
+
+        trackables -- list of Trackable objects defining the state columns to keep
+        markers    -- flag to keep the unlabeled markers
+        """
+        ids = [t.id for t in trackables]
+        if ids == self.body_ids and (markers or not self.markers):
+            return self
+
+        selected = FrameArrays(trackables, 0, markers and self.markers, self.extended)
+        for name in self.array_names:
+            setattr(selected, name, getattr(self, name))
+        selected.marker_names = self.marker_names
+        selected.count = self.count
+        selected.body_rows = [self.body_rows[self.column(id)] for id in ids]
+        if ids != self.body_ids:
+            cols = [self.column(id) for id in ids]
+            for name in self.row_names[2:]:
+                setattr(selected, name, getattr(self, name)[:, cols])
+        if not selected.markers:
+            selected.marker_offsets = np.zeros(self.count + 1, dtype=int)
+            selected.marker_positions = np.zeros((0, 3))
+            selected.marker_ids = np.zeros(0, dtype=int)
+            selected.marker_name_index = np.zeros(0, dtype=int)
+            selected.marker_names = []
+        return selected
+
+    def trk(self, id, M):
+        """Return the timestamps and N x M x 3 point cloud marker positions from the extended records for a body ID.
+
+        The timestamp is NaN for frames without a record.
+        """
+        if not self.extended or id not in self.body_ids:
+            return np.nan * np.zeros(self.count), np.nan * np.zeros((self.count, M, 3))
+        col = self.column(id)
+        t = np.array(np.where(self.trk_present[:, col], self.timestamps, np.nan))
+        return t, np.array(self.trk_ptcld[:, col, 0:M])
+
+    def marker_quality(self, id, M):
+        """Return the timestamps, tracked flags, quality, and mean error from the extended records for a body ID.
+
+        See Run.marker_quality for the array shapes.
+        """
+        if not self.extended or id not in self.body_ids:
+            return (np.nan * np.zeros(self.count), np.zeros((self.count, M), dtype=bool),
+                    np.nan * np.zeros((self.count, M)), np.nan * np.zeros(self.count))
+        col = self.column(id)
+        t = np.where(self.trk_present[:, col], self.timestamps, np.nan)
+        return t, np.array(self.trk_tracked[:, col, 0:M]), np.array(self.trk_quality[:, col, 0:M]), np.array(self.trk_error[:, col])
+
+    def padded_markers(self):
+        """Return an N x M x 3 array of marker positions, padded with NaN to the maximum marker count M."""
+        return marker_layout(self.marker_positions, self.marker_offsets, 'padded')
+
+    def __repr__( self ):
+      return "frame_arrays = {'n':%d,'l':%d,'m':%d}" % (self.count, len(self.body_ids), len(self.marker_ids))
+
+################################################################
+class FrameList(object):
+    """A read-only sequence of FrameProxy objects over FrameArrays storage.
+
+    This stands in for the list of Frame objects in a columnar run.  Each frame
+    proxy is created when accessed and is not retained.
+    """
+    __slots__ = ('arrays',)
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def __len__(self):
+        return self.arrays.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [FrameProxy(self.arrays, j) for j in range(*i.indices(self.arrays.count))]
+        if i < 0:
+            i += self.arrays.count
+        if i < 0 or i >= self.arrays.count:
+            raise IndexError("frame index out of range")
+        return FrameProxy(self.arrays, i)
+
+    def __iter__(self):
+        for i in range(self.arrays.count):
+            yield FrameProxy(self.arrays, i)
+
+    def __repr__( self ):
+      return "frame_list = {'n':%d}" % self.arrays.count
+
+class FrameProxy(object):
+    """Presents one row of FrameArrays storage with the attributes of a Frame object.
+
+    N.B. trackable_count is the number of bodies with valid states, which can
+    be less than the count in the file when a body has missing values.
+    """
+    __slots__ = ('arrays', 'row')
+
+    def __init__(self, arrays, row):
+        self.arrays = arrays
+        self.row = row
+
+    @property
+    def index(self):
+        return int(self.arrays.frame_indices[self.row])
+
+    @property
+    def timestamp(self):
+        return float(self.arrays.timestamps[self.row])
+
+    @property
+    def trackable_states(self):
+        states = self.arrays.states[self.row]
+        return [TrackableStateProxy(self.arrays, self.row, col) for col in range(len(states)) if not np.isnan(states[col, 0])]
+
+    @property
+    def trackable_count(self):
+        return len(self.trackable_states)
+
+    @property
+    def markers(self):
+        a = self.arrays
+        return [Marker(a.marker_ids[k], a.marker_positions[k], a.marker_names[a.marker_name_index[k]])
+                for k in range(a.marker_offsets[self.row], a.marker_offsets[self.row+1])]
+
+    @property
+    def marker_count(self):
+        return int(self.arrays.marker_offsets[self.row+1] - self.arrays.marker_offsets[self.row])
+
+    def __repr__( self ):
+      return "frame = {'index':%s,'t':%f,'m':%d,'l':%d}" % (self.index,self.timestamp,self.marker_count,self.trackable_count)
+
+class TrackableStateProxy(object):
+    """Presents one rigid body state of FrameArrays storage with the attributes of a TrackableState object."""
+    __slots__ = ('arrays', 'row', 'col')
+
+    def __init__(self, arrays, row, col):
+        self.arrays = arrays
+        self.row = row
+        self.col = col
+
+    @property
+    def id(self):
+        return self.arrays.body_ids[self.col]
+
+    @property
+    def pos(self):
+        return Position(self.arrays.states[self.row, self.col, 0:3])
+
+    @property
+    def qrot(self):
+        return QRot(self.arrays.states[self.row, self.col, 3:7])
+
+    @property
+    def erot(self):
+        return ERot(self.arrays.states[self.row, self.col, 7:10])
+
+    def __repr__( self ):
+      return "trk_state = {'id':%d,'pos':%s,'erot':%s}" % (self.id,self.pos,self.erot)
+
+################################################################
 class TrackableFrame():
     """Represents extended frame information for frames containing
-    rigid bodies."""
+    rigid bodies.
+
+    Each extended record has the following fields:
+      rigidbody, frame index, timestamp, name, ID, last tracked frame, marker count M,
+      M x (x,y,z) rigid body marker positions, M x (x,y,z) point cloud marker positions,
+      M x tracked flag, M x quality, mean error
+    """
 
     def __init__(self, fields):
         """Constructor for a frame of extended trackable information"""
@@ -343,25 +1529,26 @@ class TrackableFrame():
         self.id = int(fields[4])
         self.last_tracked = int(fields[5])
         self.marker_count = int(fields[6])
+
+        M = self.marker_count
         idx = 7
+        tracked_idx = idx + 6*M
+        quality_idx = idx + 7*M
+
         #Store the trackable markers
-        for i in range(self.marker_count):
-            tracked = fields[idx + (self.marker_count-i)*MSL + self.marker_count*MSL +
-                             i]
-            quality = fields[idx + (self.marker_count-i)*MSL +
-                             self.marker_count*MSL + self.marker_count + i]
-            if not( bad in ''.join(fields[idx:idx+MSL]) ):
-              self.markers.append(TrackableMarker(None, fields[idx:idx+MSL], tracked, quality))
-            idx += MSL
+        for i in range(M):
+            if not( bad in ''.join(fields[idx:idx+3]) ):
+              self.markers.append(TrackableMarker(i, fields[idx:idx+3], fields[tracked_idx+i], fields[quality_idx+i]))
+            idx += 3
         #Store the point cloud markers
-        for i in range(self.marker_count):
-            if not( bad in ''.join(fields[idx:idx+MSL]) ):
-                self.ptcld_markers.append(Marker(None, fields[idx:idx+MSL]))
-            idx += MSL
+        for i in range(M):
+            if not( bad in ''.join(fields[idx:idx+3]) ):
+                self.ptcld_markers.append(Marker(i, fields[idx:idx+3]))
+            idx += 3
 
         self.mean_error = np.nan
-        if not( bad in ''.join(fields[idx + 2*self.marker_count]) ):
-            float(fields[idx + 2*self.marker_count])
+        if not( bad in fields[idx + 2*M] ):
+            self.mean_error = float(fields[idx + 2*M])
 
     def __repr__( self ):
       return "trk_frame = {'index':%s,'id':%s,'t':%f,'name':%s,'m':%d}" % (self.index,self.id,self.timestamp,self.name,len(self.ptcld_markers))
@@ -441,6 +1628,13 @@ class Trackable():
             self.markers.append(Position(fields[idx:idx+3]))
             idx += 3
 
+    def toFields(self):
+        """Return the rigidbody definition as a list of CSV fields."""
+        fields = ['rigidbody', self.name, str(self.id), str(self.num_markers)]
+        for m in self.markers:
+            fields += [repr(m.x), repr(m.y), repr(m.z)]
+        return fields
+
     def __repr__( self ):
       return "trk = {'id':%d,'name':%s,'m':%d}" % (self.id,self.name,self.num_markers)
 
@@ -489,3 +1683,34 @@ class ERot():
 
     def __repr__( self ):
       return "[%f,%f,%f]" % (self.yaw,self.pitch,self.roll)
+
+################################################################
+
+if __name__ == "__main__":
+    """Run some trivial tests when executed as a main module."""
+    import tempfile
+
+    # A short capture with one rigid body of two markers.  The extended record
+    # of the second frame has '#' placeholders for a missing tracked flag and
+    # quality value, which both loading modes should read as untracked and NaN.
+    text = """info,version,1.1
+info,framecount,2
+info,rigidbodycount,1
+rigidbody,Tool,1,2,0.0,0.0,0.0,0.1,0.0,0.0
+frame,0,0.000000,1,1,0.1,0.2,0.3,0.0,0.0,0.0,1.0,0.0,0.0,0.0,1,0.5,0.5,0.5,7,m7
+rigidbody,0,0.000000,Tool,1,0,2,0.1,0.2,0.3,0.2,0.2,0.3,0.1,0.2,0.3,0.2,0.2,0.3,1,1,0.9,0.8,0.001
+frame,1,0.008333,1,1,0.1,0.2,0.3,0.0,0.0,0.0,1.0,0.0,0.0,0.0,0
+rigidbody,1,0.008333,Tool,1,1,2,0.1,0.2,0.3,0.2,0.2,0.3,0.1,0.2,0.3,0.2,0.2,0.3,1,#,0.9,#,0.002
+"""
+    fd, filename = tempfile.mkstemp(suffix='.csv')
+    os.write(fd, text)
+    os.close(fd)
+    try:
+        results = []
+        for columnar in (False, True):
+            run = Run().ReadFile(os.path.dirname(filename), os.path.basename(filename), columnar=columnar, cache=False, extended=True)
+            results.append(run.marker_quality('Tool'))
+            print "columnar=%s tracked:\n%s\nquality:\n%s" % (columnar, results[-1][1], results[-1][2])
+        print "marker quality matches in both modes:", all(np.array_equal(a, b) or np.allclose(a, b, equal_nan=True) for a, b in zip(*results))
+    finally:
+        os.remove(filename)
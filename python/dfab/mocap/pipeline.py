@@ -0,0 +1,524 @@
+"""Stage-based processing pipeline for converting motion capture data into trajectories.
+
+Copyright (c) 2014, Garth Zeglin.  All rights reserved. Licensed under the terms
+of the BSD 3-clause license as included in LICENSE.
+
+A Pipeline connects a source, a list of stages, and a sink:
+
+    source -> body select -> subsample or resample -> calibrate -> simplify -> sink
+
+The source generates blocks of frames; each stage receives a chunk of data and
+returns a new chunk, which may be empty; the sink consumes the final chunks,
+e.g. by writing them to a file.  Only a bounded number of frames is held by
+each stage at a time, so a streaming source keeps the peak memory use
+independent of the length of the capture.
+
+After the source is exhausted, each stage is given the chance to return any
+data it has held back, such as samples awaiting the next chunk for filtering.
+
+A new stage is written as a subclass of Stage with a process() method and, if
+it holds back data, a finish() method.  The chunks passed after body selection
+are TrajectoryChunk objects holding arrays for a single body.
+
+Given a Profile object, the pipeline records the time, memory, and number of
+rows for the source, each stage, and the sink.  Without one, the pipeline
+runs without any instrumentation.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import dfab.mocap.optitrack_csv as optitrack
+import dfab.mocap.datafiles as datafiles
+import dfab.mocap.extract_trajectory as extract
+import dfab.geometry
+
+try:
+    import resource
+except ImportError:
+    resource = None     # not available on Windows
+
+################################################################
+class TrajectoryChunk(object):
+    """A contiguous block of samples of a single body trajectory.
+
+    Object attributes:
+    times   N element array of timestamps (in seconds)
+    x       N x 3 array of positions (in millimeters)
+    q       N x 4 array of (w,x,y,z) orientation quaternions
+    ypr     N x 3 array of yaw, pitch, roll angles (in degrees)
+    frames  N x 4 x 4 array of homogeneous transforms, or None before calibration
+    """
+
+    def __init__(self, times, x, q, ypr, frames=None):
+        self.times = times
+        self.x = x
+        self.q = q
+        self.ypr = ypr
+        self.frames = frames
+
+    def __len__(self):
+        return len(self.times)
+
+    def take(self, index):
+        """Return a new chunk holding the samples selected by an index array, slice, or boolean mask."""
+        return TrajectoryChunk(self.times[index], self.x[index], self.q[index], self.ypr[index],
+                               None if self.frames is None else self.frames[index])
+
+    @staticmethod
+    def concatenate(chunks):
+        """Return a new chunk joining a non-empty list of chunks."""
+        frames = None if any(c.frames is None for c in chunks) else np.concatenate([c.frames for c in chunks])
+        return TrajectoryChunk(np.concatenate([c.times for c in chunks]),
+                               np.concatenate([c.x for c in chunks]),
+                               np.concatenate([c.q for c in chunks]),
+                               np.concatenate([c.ypr for c in chunks]),
+                               frames)
+
+    @staticmethod
+    def empty():
+        """Return a chunk with no samples."""
+        return TrajectoryChunk(np.zeros(0), np.zeros((0,3)), np.zeros((0,4)), np.zeros((0,3)))
+
+################################################################
+class Pipeline(object):
+    """Connects a source, a sequence of stages, and a sink.
+
+    source  -- an iterable generating the input blocks, e.g. a CSVSource
+    stages  -- a list of Stage objects applied in order
+    sink    -- an object with write(chunk) and close() methods, e.g. a FrameTrajectorySink
+    profile -- optional Profile object in which to record the performance of each part
+    """
+
+    def __init__(self, source, stages, sink, profile=None):
+        self.source = source
+        self.stages = list(stages)
+        self.sink = sink
+
+        # the instrumentation is only present if requested
+        if profile is not None:
+            self.source = profile.source(source)
+            self.stages = [profile.stage(stage) for stage in self.stages]
+            self.sink = profile.sink(sink)
+
+    def run(self):
+        """Pass all the source data through the stages to the sink, then close the sink and return it."""
+        for block in self.source:
+            self.push(block, 0)
+
+        # flush the data held back by each stage through the following stages
+        for i, stage in enumerate(self.stages):
+            chunk = stage.finish()
+            if chunk is not None and len(chunk) > 0:
+                self.push(chunk, i + 1)
+
+        self.sink.close()
+        return self.sink
+
+    def push(self, chunk, start):
+        """Pass a chunk through the stages beginning with index start, then to the sink."""
+        for stage in self.stages[start:]:
+            chunk = stage.process(chunk)
+            if chunk is None or len(chunk) == 0:
+                return
+        self.sink.write(chunk)
+
+################################################################
+# Sources.
+
+class CSVSource(object):
+    """Generates FrameArrays blocks by streaming an Optitrack CSV file.
+
+    The Run object is available as the 'run' attribute; its header
+    information, e.g. the list of trackables, is valid once the first block
+    has been generated.
+    """
+
+    def __init__(self, filename, bodies=None, chunk=1200):
+        self.filename = filename
+        self.bodies = bodies
+        self.chunk = chunk
+        self.run = optitrack.Run()
+
+    def __iter__(self):
+        return self.run.iter_frames(".", self.filename, bodies=self.bodies, chunk=self.chunk, markers=False)
+
+class RunSource(object):
+    """Generates the arrays of a Run already loaded in columnar mode as a single block."""
+
+    def __init__(self, run):
+        self.run = run
+
+    def __iter__(self):
+        yield self.run.arrays
+
+################################################################
+# Stages.
+
+class Stage(object):
+    """Base class for a pipeline stage.
+
+    process() receives each chunk in order and returns the output chunk, which
+    may be empty.  finish() is called once after the last chunk and returns
+    any data held back, or None.
+    """
+
+    def process(self, chunk):
+        return chunk
+
+    def finish(self):
+        return None
+
+class BodySelect(Stage):
+    """Converts FrameArrays blocks into a TrajectoryChunk of the samples in which a named body appears.
+
+    The positions are converted to millimeters and the quaternions to (w,x,y,z) order.
+    As in Run.trajectories, the first few frames missing the body are
+    reported, followed by the total once the last block has been processed.
+
+    run      -- the Run object providing the list of trackables, e.g. source.run
+    body     -- the name of the body
+    warnings -- the number of missing frames to report individually, or 0 for none
+    """
+
+    def __init__(self, run, body, warnings=5):
+        self.run = run
+        self.body = body
+        self.warnings = warnings
+        self.frames = 0
+        self.missing = 0
+
+    def process(self, block):
+        body_id = self.run.select_trackables([self.body])[0].id
+        states = block.states[:, block.column(body_id), :]
+        absent = np.isnan(states[:,0])
+        present = np.flatnonzero(~absent)
+        if self.warnings:
+            self.report(self.frames + np.flatnonzero(absent))
+        self.frames += len(states)
+        x, q = extract.convert_mocap_units(states[present, 0:3], states[present, 3:7])
+        return TrajectoryChunk(block.timestamps[present], x, q, states[present, 7:10])
+
+    def report(self, missing):
+        """Print a warning for each of the first missing frames, counting across blocks."""
+        for i in missing[0:max(0, self.warnings - self.missing)]:
+            print "Body '%s' does not appear in frame %d." % (self.body, i)
+        if self.missing < self.warnings <= self.missing + len(missing):
+            print "(Additional warnings for '%s' will be suppressed.)" % self.body
+        self.missing += len(missing)
+
+    def finish(self):
+        if self.warnings and self.missing:
+            print "Body '%s' does not appear in %d of %d frames." % (self.body, self.missing, self.frames)
+        return None
+
+class Subsample(Stage):
+    """Keeps every ratio'th sample, counting across chunk boundaries."""
+
+    def __init__(self, ratio):
+        self.ratio = ratio
+        self.samples = 0
+
+    def process(self, chunk):
+        keep = (self.samples + np.arange(len(chunk))) % self.ratio == 0
+        self.samples += len(chunk)
+        return chunk.take(keep)
+
+class Resample(Stage):
+    """Resamples at multiples of 1/hz seconds using extract_trajectory.resample_trajectory.
+
+    The samples near the end of each chunk are held back until the next chunk
+    arrives, so that every output is computed with the full filter kernel and
+    interpolation interval available, as for a trajectory resampled at once.
+    The filter grid interval is fixed by the first chunk.
+    """
+
+    def __init__(self, hz, max_gap=0.1, cutoff=None):
+        self.hz = hz
+        self.max_gap = max_gap
+        self.cutoff = cutoff if cutoff is not None else 0.5 * hz
+        self.held = None        # chunk of samples held back
+        self.next_time = None   # the earliest output time not yet produced
+        self.dt = None          # capture interval for the filter grid
+        self.margin = None      # time span of input needed beyond an output time
+
+    def process(self, chunk):
+        if self.held is not None:
+            chunk = TrajectoryChunk.concatenate([self.held, chunk])
+        if len(chunk) < 2:
+            self.held = chunk
+            return None
+
+        if self.dt is None:
+            self.dt = np.median(np.diff(chunk.times))
+            sigma = np.sqrt(np.log(2)) / (2 * np.pi * self.cutoff) if self.cutoff > 0 else 0.0   # filter kernel width in seconds
+            self.margin = 3 * sigma + 2 * self.dt + self.max_gap
+
+        limit = chunk.times[-1] - self.margin
+        output = self.resample(chunk, limit)
+
+        # hold back the samples needed for outputs at or after the limit
+        if self.next_time is None or limit > self.next_time:
+            self.next_time = limit
+        first = max(np.searchsorted(chunk.times, self.next_time - self.margin) - 1, 0)
+        self.held = chunk.take(slice(first, None))
+        return output
+
+    def finish(self):
+        if self.held is None or len(self.held) < 2:
+            return None
+        return self.resample(self.held, np.inf)
+
+    def resample(self, chunk, limit):
+        """Return the resampled outputs from next_time up to but not including limit."""
+        times, x, q, ypr = extract.resample_trajectory(chunk.times, chunk.x, chunk.q, chunk.ypr, self.hz,
+                                                       max_gap=self.max_gap, cutoff=self.cutoff, dt=self.dt)
+        keep = times < limit
+        if self.next_time is not None:
+            keep &= times >= self.next_time
+        return TrajectoryChunk(times[keep], x[keep], q[keep], ypr[keep])
+
+class Calibrate(Stage):
+    """Computes the world-frame homogeneous transform of each sample given the mocap-to-world transform."""
+
+    def __init__(self, mocap_to_world):
+        self.mocap_to_world = np.asarray(mocap_to_world)
+
+    def process(self, chunk):
+        tool_traj = dfab.geometry.pos_quat_to_threexform(chunk.x, chunk.q)
+        chunk.frames = dfab.geometry.transform_threexforms(self.mocap_to_world, tool_traj)
+        return chunk
+
+class Simplify(Stage):
+    """Drops samples not needed to reproduce the path within tolerances using extract_trajectory.simplify_trajectory.
+
+    Each chunk is simplified together with the last sample retained from the
+    previous chunk, so the path remains continuous; the last sample of each
+    chunk is always retained.
+    """
+
+    def __init__(self, tolerance=1.0, angle_tolerance=1.0):
+        self.tolerance = tolerance
+        self.angle_tolerance = angle_tolerance
+        self.last = None
+
+    def process(self, chunk):
+        if self.last is not None:
+            chunk = TrajectoryChunk.concatenate([self.last, chunk])
+        keep = extract.simplify_trajectory(chunk.times, chunk.x, chunk.q, self.tolerance, self.angle_tolerance)
+        if self.last is not None:
+            keep = keep[1:]
+        self.last = chunk.take(slice(-1, None))
+        return chunk.take(keep)
+
+################################################################
+# Sinks.
+
+class FrameTrajectorySink(object):
+    """Writes calibrated chunks to a frame trajectory file as they arrive."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self.file = open(filename, "w")
+        datafiles.write_frame_trajectory_header(self.file)
+
+    def write(self, chunk):
+        datafiles.write_frame_trajectory_frames(self.file, chunk.times, chunk.frames)
+        self.count += len(chunk)
+
+    def close(self):
+        self.file.close()
+
+class PrintSink(object):
+    """Prints the transform of each calibrated sample to the console."""
+
+    def __init__(self):
+        self.count = 0
+        print "Trajectory:"
+
+    def write(self, chunk):
+        for m in chunk.frames: print m
+        self.count += len(chunk)
+
+    def close(self):
+        pass
+
+class ArraySink(object):
+    """Collects the chunks in memory; result() returns them joined into one TrajectoryChunk."""
+
+    def __init__(self):
+        self.count = 0
+        self.chunks = []
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+        self.count += len(chunk)
+
+    def close(self):
+        pass
+
+    def result(self):
+        return TrajectoryChunk.concatenate(self.chunks) if self.chunks else TrajectoryChunk.empty()
+
+################################################################
+# Profiling.
+
+def peak_memory():
+    """Return the peak resident memory of this process in megabytes, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # the units are bytes on OS X, else kilobytes
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+def cpu_time():
+    """Return the user and system CPU time used by this process in seconds."""
+    t = os.times()
+    return t[0] + t[1]
+
+def chunk_rows(chunk):
+    """Return the number of rows in a FrameArrays block or TrajectoryChunk."""
+    return chunk.count if isinstance(chunk, optitrack.FrameArrays) else len(chunk)
+
+def loaded_frames(run):
+    """Return the number of frames actually loaded into a Run, or 0 for another object."""
+    if getattr(run, 'arrays', None) is not None:
+        return run.arrays.count
+    return len(getattr(run, 'frames', ()))
+
+class Profile(object):
+    """Records the performance of each part of a pipeline.
+
+    For each named part this accumulates the wall-clock time, the CPU time,
+    and the number of rows it received (or generated, for the source).  The
+    rate in rows/sec is omitted for a part recorded as unrated, e.g. a
+    source which only iterates over data already in memory.  The
+    peak memory is the process peak resident size observed after the part
+    last ran, so it attributes a memory increase to the part which caused it
+    but is otherwise cumulative.
+
+    Object attributes:
+    names    list of part names in the order first recorded
+    records  dictionary mapping each name to a dictionary of totals
+    """
+
+    def __init__(self):
+        self.names = []
+        self.records = {}
+
+    def record(self, name, wall, cpu, rows, rated=True):
+        """Add the measurements of one call to the totals for a named part."""
+        if name not in self.records:
+            self.names.append(name)
+            self.records[name] = { 'wall' : 0.0, 'cpu' : 0.0, 'rows' : 0, 'calls' : 0, 'peak_mb' : None, 'rated' : rated }
+        r = self.records[name]
+        r['wall'] += wall
+        r['cpu'] += cpu
+        r['rows'] += rows
+        r['calls'] += 1
+        r['peak_mb'] = peak_memory()
+
+    def measure(self, name, function, *args, **kwargs):
+        """Call a function, recording its performance under the given name, and return its result.
+
+        The number of rows is the number of frames loaded if the result is a
+        Run, else 0.
+        """
+        wall, cpu = time.time(), cpu_time()
+        result = function(*args, **kwargs)
+        self.record(name, time.time() - wall, cpu_time() - cpu, loaded_frames(result))
+        return result
+
+    def source(self, source):
+        return ProfiledSource(self, source)
+
+    def stage(self, stage):
+        return ProfiledStage(self, stage)
+
+    def sink(self, sink):
+        return ProfiledSink(self, sink)
+
+    def as_dict(self):
+        """Return the records as a list of dictionaries including the name and rows/sec of each part."""
+        result = []
+        for name in self.names:
+            r = dict(self.records[name])
+            r['name'] = name
+            r['rows_per_sec'] = r['rows'] / r['wall'] if r['rated'] and r['wall'] > 0 else None
+            result.append(r)
+        return result
+
+    def report(self):
+        """Return the records formatted as a text table."""
+        lines = ["%-20s %9s %9s %10s %12s %9s" % ('stage', 'wall (s)', 'cpu (s)', 'rows', 'rows/sec', 'peak MB')]
+        for r in self.as_dict():
+            lines.append("%-20s %9.3f %9.3f %10d %12s %9s" % (r['name'], r['wall'], r['cpu'], r['rows'],
+                                                             '-' if r['rows_per_sec'] is None else "%.0f" % r['rows_per_sec'],
+                                                             '-' if r['peak_mb'] is None else "%.1f" % r['peak_mb']))
+        return "\n".join(lines)
+
+class ProfiledSource(object):
+    """Wraps a pipeline source to record the time spent generating each block as 'source'.
+
+    A RunSource only iterates over data already loaded, so no rate is reported for it.
+    """
+
+    def __init__(self, profile, source):
+        self.profile = profile
+        self.source = source
+        self.rated = not isinstance(source, RunSource)
+
+    def __iter__(self):
+        blocks = iter(self.source)
+        while True:
+            wall, cpu = time.time(), cpu_time()
+            try:
+                block = next(blocks)
+            except StopIteration:
+                return
+            self.profile.record('source', time.time() - wall, cpu_time() - cpu, chunk_rows(block), self.rated)
+            yield block
+
+class ProfiledStage(Stage):
+    """Wraps a pipeline stage to record its performance under its class name."""
+
+    def __init__(self, profile, stage):
+        self.profile = profile
+        self.stage = stage
+        self.name = stage.__class__.__name__
+
+    def process(self, chunk):
+        wall, cpu = time.time(), cpu_time()
+        result = self.stage.process(chunk)
+        self.profile.record(self.name, time.time() - wall, cpu_time() - cpu, chunk_rows(chunk))
+        return result
+
+    def finish(self):
+        wall, cpu = time.time(), cpu_time()
+        result = self.stage.finish()
+        self.profile.record(self.name, time.time() - wall, cpu_time() - cpu, 0)
+        return result
+
+class ProfiledSink(object):
+    """Wraps a pipeline sink to record its performance as 'sink'; other attributes are those of the sink."""
+
+    def __init__(self, profile, sink):
+        self.profile = profile
+        self.sink = sink
+
+    def write(self, chunk):
+        wall, cpu = time.time(), cpu_time()
+        self.sink.write(chunk)
+        self.profile.record('sink', time.time() - wall, cpu_time() - cpu, chunk_rows(chunk))
+
+    def close(self):
+        wall, cpu = time.time(), cpu_time()
+        self.sink.close()
+        self.profile.record('sink', time.time() - wall, cpu_time() - cpu, 0)
+
+    def __getattr__(self, name):
+        return getattr(self.sink, name)
+
+################################################################
@@ -9,8 +9,13 @@ from a trajectory data file.  The path is returned as a list of Plane objects.
 Each plane is created using an origin vector and X and Y basis vectors.  The
 time stamps and Z basis vectors in the trajectory file are ignored.
 
+The trajectory is streamed from the file without building the complete
+nested-list structure, so large trajectories load quickly.  Either the plain
+text or the binary trajectory format may be used.
+
 Inputs visible in Grasshopper:
   library_path --- full path to dFab Python library
+  stride       --- optional, use every stride'th frame of the trajectory (default 1)
 
 Outputs visible in Grasshopper:
   a  -- the list of planes
@@ -26,6 +31,12 @@ import os
 # set up the Python load path to find the dFab library
 sys.path.append( library_path )
 
+# the decimation input is optional
+try:
+    stride = int( stride ) if stride else 1
+except NameError:
+    stride = 1
+
 import dfab
 import dfab.mocap.datafiles as datafiles
 
@@ -40,20 +51,17 @@ else:
 # This is reaching outside the dfab package proper.
 filename = os.path.join( dfab.dfab_package_path(), "../dfab-data/motion_capture_example/2014-01-17-Wall-Sweep-with-Robot.traj" )
 
-# load the trajectory data
-path, timestamps = datafiles.read_frame_trajectory_file( filename )
-
 # Create a list of Rhino 'plane' objects to return as a path.
 planes = []
+timestamps = []
 
 # Each Rhino 'plane' is constructed from an origin and two basis vectors using
 # PlaneFromFrame. Syntax of the PlaneFromFrame operator:
 # rs.PlaneFromFrame (origin, x_axis, y_axis)
 
-for f in path:
-    origin = f[0]
-    xaxis  = f[1]
-    yaxis  = f[2]
+# stream the trajectory data from the file one frame at a time
+for time, origin, xaxis, yaxis, zaxis in datafiles.iter_frame_trajectory( filename, stride ):
+    timestamps.append( time )
     planes.append( rs.PlaneFromFrame( origin, xaxis, yaxis ))
 
 # Return the list in a global variable exposed in the Grasshopper interface.